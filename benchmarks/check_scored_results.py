@@ -0,0 +1,64 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.append(REPO_DIR)
+sys.path.append(os.path.join(REPO_DIR, "run_functions"))
+from functions.effects import surprisal_effects
+from run_surprisal import write_effects
+
+# Regression check for run_surprisal reading a directory that holds both a committed CSV and a newer parquet file of the
+# same experiment, as data/surprisal_results does after `rolereversal score`: the models only the parquet file scores
+# must get effects, and the differing model sets must be reported. Exits with an error otherwise.
+
+def main():
+    data_dir = os.path.join(REPO_DIR, "data")
+    with open(os.path.join(data_dir, "stimulus_config.json"), "r") as file:
+        config = {"KO_clean.csv": json.load(file)["KO_clean.csv"]}
+    with tempfile.TemporaryDirectory(prefix="rolereversal-check-") as surprisal_dir:
+        shutil.copy(os.path.join(data_dir, "surprisal_results", "KO_clean.csv"), surprisal_dir)
+        stale = pd.read_csv(os.path.join(surprisal_dir, "KO_clean.csv"))
+        # a newer sweep of one of the committed models and a new one
+        scored = stale.drop(columns=[column for column in stale.columns if "surprisal" in column])
+        scored["gpt2_surprisal"] = stale["gpt2_surprisal"] * 2
+        scored["new-model_surprisal"] = np.random.default_rng(0).random(len(scored))
+        parquet_path = os.path.join(surprisal_dir, "KO_clean.parquet")
+        scored.to_parquet(parquet_path, index=False)
+        os.utime(parquet_path, (time.time() + 10, time.time() + 10))
+        config_path = os.path.join(surprisal_dir, "config.json")
+        with open(config_path, "w") as file:
+            json.dump(config, file)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            effects_path = write_effects(surprisal_dir, config_path, n_resamples=100)
+        effects = pd.read_csv(effects_path)
+        effect_stats = pd.read_csv(os.path.join(surprisal_dir, "surprisal_effects_stats.csv"))
+
+    errors = []
+    if "Warning:" not in output.getvalue():
+        errors.append("no warning that the CSV and parquet files score different models")
+    counts = effect_stats.groupby("model")["n_items"].min()
+    for model in ["new-model", "gpt2", "roberta-large"]:
+        if counts.get(model, 0) == 0:
+            errors.append(f"{model} has no scored items")
+    column = "gpt2_surprisal_surprisal_effect"
+    expected = surprisal_effects(scored, ["gpt2_surprisal"], config["KO_clean.csv"]["reversal"], "Reversal")[column]
+    if not np.allclose(effects.loc[effects["condition"] == "Reversal", column].to_numpy(), expected.to_numpy(), equal_nan=True):
+        errors.append("gpt2 effects were not computed from the newer parquet file")
+    if errors:
+        print("\n".join(["Scored results check FAILED:"] + [f"  {error}" for error in errors]))
+        sys.exit(1)
+    print("Scored results check passed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.append(REPO_DIR)
+sys.path.append(os.path.join(REPO_DIR, "run_functions"))
+from functions import attention, instrument, probe
+from functions.instrument import peak_rss_mb
+from functions.surprisal import surprisal_at_word
+from surprisal_for_model import load_model as load_scorer
+from transformers import AutoModel, AutoTokenizer
+from tiny_models import TINY_MODELS, build_tiny_models
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput benchmarks for surprisal, probing and attention on tiny local models')
+    parser.add_argument('--data-dir', default=os.path.join(REPO_DIR, 'data'), help='Directory with the stimulus CSVs')
+    parser.add_argument('--suites', nargs='+', choices=['surprisal', 'probe', 'attention'], default=['surprisal', 'probe', 'attention'])
+    parser.add_argument('--models', nargs='+', choices=TINY_MODELS, default=TINY_MODELS)
+    parser.add_argument('--scale', type=int, default=4, help='Size of the synthetic set as a multiple of the real stimuli (0 to skip)')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed runs per benchmark; the fastest is reported')
+    parser.add_argument('--output', default=None, help='Write the results as JSON to this path')
+    parser.add_argument('--baseline', default=os.path.join(BENCHMARK_DIR, 'baseline.json'), help='Stored results to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='Store these results as the new baseline instead of comparing')
+    parser.add_argument('--no-compare', action='store_true', help='Only report the results, without a baseline to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative slowdown (or memory growth) before failing')
+
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    with tempfile.TemporaryDirectory(prefix="rolereversal-bench-") as model_dir:
+        start = time.perf_counter()
+        model_paths = build_tiny_models(model_dir, args.data_dir)
+        print(f"Built tiny models in {time.perf_counter() - start:.2f}s")
+        datasets = benchmark_datasets(args.data_dir, args.scale)
+        results = run_benchmarks(args.suites, [model_paths[model_name] for model_name in args.models], datasets, args.repeats)
+    report = {
+        "environment": {"python": platform.python_version(), "torch": torch.__version__, "threads": torch.get_num_threads(), "machine": platform.machine()},
+        "benchmarks": results,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print_results(report)
+    if args.output:
+        write_json(report, args.output)
+    if args.save_baseline:
+        write_json(report, args.baseline)
+        print(f"Saved baseline to {args.baseline}")
+    elif args.no_compare:
+        return
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r") as file:
+            regressions = compare_to_baseline(report, json.load(file), args.tolerance)
+        if regressions:
+            print("\n".join(["", "PERFORMANCE REGRESSION against " + args.baseline] + regressions))
+            sys.exit(1)
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    else:
+        # a run that cannot be compared must not pass as one without regressions
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline to store one, or --no-compare to only report the results")
+        sys.exit(1)
+
+def stimulus_pairs(data_dir : str):
+    # one plausible / implausible row pair per (exp, item, type), as in the probing experiments
+    df = pd.read_csv(os.path.join(data_dir, "df_comb.csv"))
+    pairs = df.pivot_table(index=["exp", "item", "type"], columns="plausibility", values=["sentence", "target"], aggfunc="first").dropna()
+    # a few stimuli spell the verb differently from the target column; run_probe only warns about those, here they are skipped
+    contains_verbs = [all(target in sentence for sentence, target in zip(row['sentence'], row['target'])) for _, row in pairs.iterrows()]
+    return pairs[contains_verbs]
+
+def scaled(data : pd.DataFrame, factor : int):
+    # synthetic set: the real stimuli repeated factor times in a shuffled order
+    return pd.concat([data] * factor).sample(frac=1, random_state=0).reset_index(drop=True)
+
+def benchmark_datasets(data_dir : str, scale : int):
+    with open(os.path.join(data_dir, "stimulus_config.json"), "r") as file:
+        stimulus_config = json.load(file)
+    scoring = pd.concat([pd.read_csv(os.path.join(data_dir, filename))[['sentence', 'target']] for filename in stimulus_config], ignore_index=True)
+    df_comb = pd.read_csv(os.path.join(data_dir, "df_comb.csv"))
+    datasets = {"real": {
+        "surprisal": scoring,
+        "probe": stimulus_pairs(data_dir),
+        "attention": df_comb[(df_comb.exp == "WY") & df_comb['type'].isin(["substitution", "reversal"])],
+    }}
+    if scale > 0:
+        datasets[f"synthetic_x{scale}"] = {suite: scaled(data, scale) for suite, data in datasets["real"].items()}
+    return datasets
+
+def timed(fn, *args, repeats : int = 1):
+    # fastest of repeats runs; returns the result of the last run, the wall time of the fastest run and the seconds
+    # spent in each instrument stage (tokenization, forward passes, alignment, probe fits, ...) during that run
+    best, best_stages = float("inf"), {}
+    for _ in range(repeats):
+        instrument.reset()
+        start = time.perf_counter()
+        result = fn(*args)
+        seconds = time.perf_counter() - start
+        if seconds < best:
+            best, best_stages = seconds, {name: entry["seconds"] for name, entry in instrument.collect()["stages"].items()}
+    return result, best, best_stages
+
+def combined_stages(*stages):
+    total = {}
+    for run_stages in stages:
+        for name, seconds in run_stages.items():
+            total[name] = total.get(name, 0.0) + seconds
+    return total
+
+def throughput(sentences, tokenizer, seconds : float, stages : dict):
+    n_tokens = sum(len(ids) for ids in tokenizer(list(sentences))['input_ids'])
+    return {
+        "sentences": len(sentences),
+        "tokens": n_tokens,
+        "seconds": seconds,
+        "sentences_per_sec": len(sentences) / seconds,
+        "tokens_per_sec": n_tokens / seconds,
+        "stages": stages,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def bench_surprisal(model_path : str, data : pd.DataFrame, repeats : int):
+    model, _, load_stages = timed(load_scorer, model_path)
+    sentences = data['sentence'].str.lower() if 'uncased' in model_path else data['sentence']
+    _, seconds, stages = timed(surprisal_at_word, model, sentences.tolist(), data['target'].tolist(), repeats=repeats)
+    return throughput(sentences, model.tokenizer, seconds, combined_stages(load_stages, stages))
+
+def bench_probe(model_path : str, pairs : pd.DataFrame, repeats : int):
+    model, _, load_stages = timed(probe.load_model, model_path)
+    sentences = np.column_stack([pairs[('sentence', 'plausible')], pairs[('sentence', 'implausible')]]).ravel().tolist()
+    verbs = np.column_stack([pairs[('target', 'plausible')], pairs[('target', 'implausible')]]).ravel().tolist()
+    labels = [0, 1] * len(pairs)
+    probe_layers = list(range(1, model.layers + 1))
+    layer_embeddings, embedding_seconds, embedding_stages = timed(probe.extract_verb_embeddings_by_layer, model, sentences, verbs, probe_layers,
+                                                                  repeats=repeats)
+    _, probing_seconds, probing_stages = timed(probe.run_layer_probing, layer_embeddings, labels, 10, 0, repeats=repeats)
+    stages = combined_stages(load_stages, embedding_stages, probing_stages)
+    return throughput(sentences, model.tokenizer, embedding_seconds + probing_seconds, stages)
+
+def bench_attention(model_path : str, data : pd.DataFrame, repeats : int):
+    (model, tokenizer), _, load_stages = timed(load_attention_model, model_path)
+    _, seconds, stages = timed(attention.process_attention, data, model, tokenizer, repeats=repeats)
+    return throughput(data['sentence'], tokenizer, seconds, combined_stages(load_stages, stages))
+
+def load_attention_model(model_path : str):
+    # as in run_attention.py
+    with instrument.stage("load_model"):
+        return AutoModel.from_pretrained(model_path).eval(), AutoTokenizer.from_pretrained(model_path)
+
+SUITES = {"surprisal": bench_surprisal, "probe": bench_probe, "attention": bench_attention}
+
+def run_benchmarks(suites, model_paths, datasets, repeats : int):
+    results = {}
+    for suite in suites:
+        for model_path in model_paths:
+            model_name = os.path.basename(model_path)
+            for dataset_name, data in datasets.items():
+                key = f"{suite}/{model_name}/{dataset_name}"
+                print(f"Running benchmark: {key}")
+                results[key] = SUITES[suite](model_path, data[suite], repeats)
+    return results
+
+def print_results(report):
+    rows = [{"benchmark": key, "sentences/s": result["sentences_per_sec"], "tokens/s": result["tokens_per_sec"],
+             "seconds": result["seconds"], **{f"{stage} (s)": seconds for stage, seconds in result["stages"].items()}}
+            for key, result in report["benchmarks"].items()]
+    print(pd.DataFrame(rows).set_index("benchmark").round(3).fillna("").to_string())
+    print(f"Peak RSS: {report['peak_rss_mb']:.1f} MB")
+
+def compare_to_baseline(report, baseline, tolerance : float):
+    regressions = []
+    for key, result in report["benchmarks"].items():
+        if key not in baseline["benchmarks"]:
+            continue
+        expected = baseline["benchmarks"][key]["sentences_per_sec"]
+        if result["sentences_per_sec"] < expected * (1 - tolerance):
+            regressions.append(f"  {key}: {result['sentences_per_sec']:.1f} sentences/s, baseline {expected:.1f}")
+    if report["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append(f"  peak RSS: {report['peak_rss_mb']:.1f} MB, baseline {baseline['peak_rss_mb']:.1f} MB")
+    return regressions
+
+def write_json(report, path : str):
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+
+if __name__ == "__main__":
+    main()
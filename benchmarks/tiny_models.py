@@ -0,0 +1,61 @@
+import glob
+import os
+from typing import Dict, List
+
+import pandas as pd
+import torch
+from tokenizers import ByteLevelBPETokenizer, BertWordPieceTokenizer
+from tokenizers.processors import RobertaProcessing
+from transformers import (BertConfig, BertForMaskedLM, BertTokenizerFast, GPT2Config, GPT2LMHeadModel, GPT2TokenizerFast,
+                          RobertaConfig, RobertaForMaskedLM, RobertaTokenizerFast)
+
+# directory names keep the substrings the loaders dispatch on ('gpt' -> incremental scorer, 'uncased' -> lowercasing)
+TINY_MODELS = ["tiny-gpt2", "tiny-bert-uncased", "tiny-roberta"]
+
+def stimulus_sentences(data_dir : str) -> List[str]:
+    sentences = []
+    for path in sorted(glob.glob(os.path.join(data_dir, "*.csv"))):
+        sentences += pd.read_csv(path)['sentence'].dropna().tolist()
+    return sentences
+
+def tiny_gpt2(sentences : List[str], vocab_size : int, hidden_size : int, layers : int):
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(sentences, vocab_size = vocab_size, special_tokens = ["<|endoftext|>"], show_progress = False)
+    tokenizer = GPT2TokenizerFast(tokenizer_object = bpe, bos_token = "<|endoftext|>", eos_token = "<|endoftext|>", unk_token = "<|endoftext|>")
+    config = GPT2Config(vocab_size = len(tokenizer), n_embd = hidden_size, n_layer = layers, n_head = 4, n_positions = 256)
+    return GPT2LMHeadModel(config), tokenizer
+
+def tiny_bert(sentences : List[str], vocab_size : int, hidden_size : int, layers : int):
+    wordpiece = BertWordPieceTokenizer(lowercase = True)
+    wordpiece.train_from_iterator(sentences, vocab_size = vocab_size, show_progress = False)
+    tokenizer = BertTokenizerFast(tokenizer_object = wordpiece, unk_token = "[UNK]", pad_token = "[PAD]", cls_token = "[CLS]",
+                                  sep_token = "[SEP]", mask_token = "[MASK]", do_lower_case = True)
+    config = BertConfig(vocab_size = len(tokenizer), hidden_size = hidden_size, num_hidden_layers = layers, num_attention_heads = 4,
+                        intermediate_size = 4 * hidden_size, max_position_embeddings = 256)
+    return BertForMaskedLM(config), tokenizer
+
+def tiny_roberta(sentences : List[str], vocab_size : int, hidden_size : int, layers : int):
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(sentences, vocab_size = vocab_size, special_tokens = ["<s>", "<pad>", "</s>", "<unk>", "<mask>"], show_progress = False)
+    bpe.post_processor = RobertaProcessing(("</s>", bpe.token_to_id("</s>")), ("<s>", bpe.token_to_id("<s>")))
+    tokenizer = RobertaTokenizerFast(tokenizer_object = bpe, bos_token = "<s>", eos_token = "</s>", sep_token = "</s>", cls_token = "<s>",
+                                     pad_token = "<pad>", unk_token = "<unk>", mask_token = "<mask>")
+    config = RobertaConfig(vocab_size = len(tokenizer), hidden_size = hidden_size, num_hidden_layers = layers, num_attention_heads = 4,
+                           intermediate_size = 4 * hidden_size, pad_token_id = tokenizer.pad_token_id, max_position_embeddings = 258)
+    return RobertaForMaskedLM(config), tokenizer
+
+def build_tiny_models(output_dir : str, data_dir : str, vocab_size : int = 1000, hidden_size : int = 64, layers : int = 4,
+                      seed : int = 0) -> Dict[str, str]:
+    # randomly initialized GPT-2, BERT and RoBERTa with tokenizers trained on the stimuli, saved so the
+    # repo loaders can open them by path like any hub model; returns {model name: path}
+    sentences = stimulus_sentences(data_dir)
+    builders = {"tiny-gpt2": tiny_gpt2, "tiny-bert-uncased": tiny_bert, "tiny-roberta": tiny_roberta}
+    paths = {}
+    for model_name, builder in builders.items():
+        torch.manual_seed(seed)
+        model, tokenizer = builder(sentences, vocab_size, hidden_size, layers)
+        path = os.path.join(output_dir, model_name)
+        model.save_pretrained(path)
+        tokenizer.save_pretrained(path)
+        paths[model_name] = path
+    return paths
@@ -0,0 +1,135 @@
+from typing import Dict, List, Tuple
+
+import pandas as pd
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from functions import instrument
+
+AGENT, PATIENT = 0, 1
+
+# Function to get token indices for matching sequences of subtokens
+def get_matching_subtoken_indices(sentence_tokens : List[str], word_tokens : List[str]):
+    indices = []
+    i = 0
+    while i < len(sentence_tokens):
+        if sentence_tokens[i:i+len(word_tokens)] == word_tokens:
+            indices.extend(range(i, i+len(word_tokens)))
+            i += len(word_tokens)
+        else:
+            i += 1
+    return indices
+
+def encode_stimuli(tokenizer, data : pd.DataFrame):
+    # token ids plus target row mask and (agent, patient) column masks for every sentence
+    encoded = tokenizer(data['sentence'].tolist())
+    role_words = pd.unique(data[['target', 'agent', 'patient']].values.ravel())
+    word_tokens = {word: tokenizer.tokenize(" " + word) for word in role_words}
+    stimuli = []
+    for input_ids, (_, row) in zip(encoded['input_ids'], data.iterrows()):
+        sentence_tokens = tokenizer.convert_ids_to_tokens(input_ids)
+        target_mask = torch.zeros(len(input_ids))
+        role_masks = torch.zeros(len(input_ids), 2)
+        target_mask[get_matching_subtoken_indices(sentence_tokens, word_tokens[row['target']])] = 1
+        role_masks[get_matching_subtoken_indices(sentence_tokens, word_tokens[row['agent']]), AGENT] = 1
+        role_masks[get_matching_subtoken_indices(sentence_tokens, word_tokens[row['patient']]), PATIENT] = 1
+        stimuli.append((torch.tensor(input_ids), target_mask, role_masks))
+    return stimuli
+
+def length_batches(lengths : List[int], batch_size : int):
+    # sort by length so each padded batch holds sentences of similar length
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+def transformer_layers(model):
+    # the stack of transformer blocks for GPT-2 style decoders and BERT/RoBERTa encoders
+    base = model.base_model
+    return base.h if hasattr(base, 'h') else base.encoder.layer
+
+def attention_modules(model):
+    # the self-attention module of every layer
+    return [layer.attn if hasattr(layer, 'attn') else layer.attention.self for layer in transformer_layers(model)]
+
+def role_attention(attn_weights : torch.Tensor, target_mask : torch.Tensor, role_masks : torch.Tensor):
+    # (batch, heads, seq, seq) -> (batch, heads, {agent, patient}) summed over target rows and role columns
+    return torch.einsum('bhqk,bq,bkr->bhr', attn_weights, target_mask.to(attn_weights.dtype), role_masks.to(attn_weights.dtype))
+
+def capture_role_attention(model, inputs : Dict, target_mask : torch.Tensor, role_masks : torch.Tensor):
+    # keep only the target-row x role-column attention of every layer; full matrices are dropped from the outputs
+    layer_scores = []
+    def hook(module, hook_inputs, output):
+        layer_scores.append(role_attention(output[-1], target_mask, role_masks))
+        return output[:-1] + (None,)
+    handles = [module.register_forward_hook(hook) for module in attention_modules(model)]
+    try:
+        model(**inputs, output_attentions=True)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return torch.stack(layer_scores, dim=1)
+
+def attention_scores(model, tokenizer, data : pd.DataFrame, capture : str = "hooks", batch_size : int = 32):
+    # (num_sentences, num_layers, num_heads, {agent, patient}) attention from the target to each role, in row order
+    if capture not in ("hooks", "outputs"):
+        raise ValueError(f"Unknown attention capture mode: {capture}")
+    with instrument.stage("tokenize", len(data)):
+        stimuli = encode_stimuli(tokenizer, data)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    scores = [None] * len(stimuli)
+    for batch in length_batches([len(stimulus[0]) for stimulus in stimuli], batch_size):
+        input_ids, target_mask, role_masks = zip(*[stimuli[i] for i in batch])
+        lengths = torch.tensor([len(ids) for ids in input_ids])
+        inputs = {
+            'input_ids': pad_sequence(input_ids, batch_first=True, padding_value=pad_token_id),
+            'attention_mask': (torch.arange(lengths.max()) < lengths[:, None]).long(),
+        }
+        target_mask = pad_sequence(target_mask, batch_first=True)
+        role_masks = pad_sequence(role_masks, batch_first=True)
+        with torch.no_grad(), instrument.forward("attention_forward", len(batch)):
+            if capture == "hooks":
+                batch_scores = capture_role_attention(model, inputs, target_mask, role_masks)
+            else:
+                outputs = model(**inputs, output_attentions=True)
+                batch_scores = torch.stack([role_attention(attn, target_mask, role_masks) for attn in outputs.attentions], dim=1)
+        for i, sentence_scores in zip(batch, batch_scores.float()):
+            scores[i] = sentence_scores
+    return torch.stack(scores)
+
+def max_attention_heads(scores : torch.Tensor) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    # scores: (num_sentences, num_layers, num_heads, 2); pick the head with the highest average attention per role
+    mean_scores = scores.mean(dim=0)
+    num_heads = mean_scores.shape[1]
+    flat_argmax = mean_scores.flatten(0, 1).argmax(dim=0).tolist()
+    agent_layer_head = divmod(flat_argmax[AGENT], num_heads)
+    patient_layer_head = divmod(flat_argmax[PATIENT], num_heads)
+    return agent_layer_head, patient_layer_head
+
+def assign_head_columns(group : pd.DataFrame, scores : torch.Tensor):
+    (max_agent_layer, max_agent_head), (max_patient_layer, max_patient_head) = max_attention_heads(scores)
+
+    # attention values from the max layer and head for each sentence
+    agent_head_scores = scores[:, max_agent_layer, max_agent_head].numpy()
+    patient_head_scores = scores[:, max_patient_layer, max_patient_head].numpy()
+
+    group['max_attn_to_agent'] = agent_head_scores[:, AGENT]
+    group['max_attn_to_patient'] = patient_head_scores[:, PATIENT]
+    group['agent_layer_head'] = [(max_agent_layer, max_agent_head)] * len(group)
+    group['patient_layer_head'] = [(max_patient_layer, max_patient_head)] * len(group)
+    group['agent_layer_patient_attn'] = agent_head_scores[:, PATIENT]
+    group['patient_layer_agent_attn'] = patient_head_scores[:, AGENT]
+
+    return group
+
+# Function to process each group of sentences
+def process_group(group : pd.DataFrame, model, tokenizer, capture : str = "hooks", batch_size : int = 32):
+    return assign_head_columns(group, attention_scores(model, tokenizer, group, capture, batch_size))
+
+def process_attention(data : pd.DataFrame, model, tokenizer, capture : str = "hooks", batch_size : int = 32):
+    # score every sentence once in shared batches, then pick heads per type x plausibility group
+    scores = attention_scores(model, tokenizer, data, capture, batch_size)
+    processed_dfs = []
+    for (group_name, plausibility), positions in data.groupby(['type', 'plausibility']).indices.items():
+        print(f"\nProcessing group: {group_name}, Plausibility: {plausibility}")
+        group = data.iloc[positions].copy()
+        processed_dfs.append(assign_head_columns(group, scores[positions]))
+    return pd.concat(processed_dfs)
@@ -0,0 +1,68 @@
+import json
+import os
+import re
+from typing import Callable, Dict, Iterator, List, Optional
+
+import pandas as pd
+
+def path_name(name : str) -> str:
+    # model names like "org/model" as a single file name component
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", name.strip("/"))
+
+def file_signature(path : str) -> dict:
+    # a checkpoint only applies to the input file it was made for
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+def save(path : str, state : dict):
+    # write next to the destination, flush to disk and rename, so a crash leaves either the old or the new checkpoint
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".tmp", "w") as file:
+        json.dump(state, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+
+def load(path : Optional[str], config : dict) -> Optional[dict]:
+    # the saved state if there is one for this exact configuration, otherwise None
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, "r") as file:
+        state = json.load(file)
+    if state.get("config") != config:
+        print(f"Ignoring checkpoint {path}, it was made with different settings or inputs")
+        return None
+    return state
+
+def discard(path : Optional[str]):
+    if path and os.path.exists(path):
+        os.remove(path)
+
+def append_csv(data : pd.DataFrame, path : str, header : bool) -> int:
+    # durably append rows and return the new file size, which the checkpoint records
+    with open(path, "a") as file:
+        data.to_csv(file, header=header, index=False)
+        file.flush()
+        os.fsync(file.fileno())
+    return os.path.getsize(path)
+
+def truncate(path : str, size : int):
+    # drop rows appended after the last checkpoint, the run was interrupted before it could record them
+    with open(path, "r+") as file:
+        file.truncate(size)
+
+def resume_layers(path : Optional[str], layers : List[int], run_layers : Callable[[List[int]], Iterator], config : dict) -> Dict[int, object]:
+    """
+    Per-layer results, computing only the layers the checkpoint at path does not have yet. run_layers(missing)
+    yields one JSON-serializable result per missing layer, in order; the checkpoint is saved after every layer,
+    so an interrupted run picks up at the first unfinished layer. Without a path nothing is saved.
+    """
+    state = load(path, config) or {"config": config, "layers": {}}
+    missing = [layer for layer in layers if str(layer) not in state["layers"]]
+    if path and len(missing) < len(layers):
+        print(f"Resuming from {path}: {len(layers) - len(missing)} of {len(layers)} layers done")
+    for layer, result in zip(missing, run_layers(missing)):
+        state["layers"][str(layer)] = result
+        if path:
+            save(path, state)
+    return {layer: state["layers"][str(layer)] for layer in layers}
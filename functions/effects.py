@@ -0,0 +1,41 @@
+import pandas as pd
+from typing import List
+
+def surprisal_effects(data : pd.DataFrame, surprisal_cols : List[str], comparison_cols: List[str], condition_name : str):
+    # get the reversal and comparison columns from the stimulus config
+    # first row per (item, condition), then implausible - plausible for every surprisal column in one array operation
+    compared = data[data['condition'].isin(comparison_cols)]
+    item_ids = pd.unique(compared['item'])
+    first_rows = compared.drop_duplicates(['item', 'condition']).set_index(['condition', 'item'])[surprisal_cols]
+    implausible_comparison = get_sentence_data(first_rows, comparison_cols[0]).reindex(item_ids).to_numpy(dtype = float)
+    plausible_comparison = get_sentence_data(first_rows, comparison_cols[1]).reindex(item_ids).to_numpy(dtype = float)
+    effects = implausible_comparison - plausible_comparison
+    expt_effects = pd.DataFrame(effects, columns = [f"{column_name}_surprisal_effect" for column_name in surprisal_cols]) # should be in format {model}_surprisal
+    expt_effects.insert(0, "item", item_ids.astype(int))
+    expt_effects['condition'] = condition_name # experiments had both reversal and comparison conditions.
+    return expt_effects
+
+def get_sentence_data(item_data : pd.DataFrame, sentence_type : str):
+    # rows of one condition from a frame indexed by (condition, item), indexed by item
+    return item_data.xs(sentence_type, level = 'condition')
+
+def reversal_surprisal_effect(data: pd.DataFrame, surprisal_cols: List[str]):
+    # for Ettinger reversal items, keyed "{item}-a" (canonical) and "{item}-b" (reversed); keys are matched exactly
+    item_keys = data['item'].astype(str).str.split("-", n = 1, expand = True)
+    keyed = data.assign(item_id = item_keys[0], version = item_keys[1]).drop_duplicates(['item_id', 'version']).set_index(['version', 'item_id'])
+    item_ids = pd.unique(keyed.index.get_level_values('item_id'))
+    canonical = keyed.xs("a", level = 'version').reindex(item_ids)
+    reverse = keyed.xs("b", level = 'version').reindex(item_ids)
+    reversal_effects = pd.DataFrame({
+        "item": item_ids.astype(int),
+        "verb": canonical['target'].to_numpy(),
+        "canonical_context": canonical['context'].to_numpy(),
+        "reversed_context": reverse['context'].to_numpy(),
+        "canonical_cloze": canonical['tgt_cloze'].to_numpy(),
+        "reversed_cloze": reverse['tgt_cloze'].to_numpy(),
+    })
+    for column_name in surprisal_cols: # should be in format {model}_surprisal
+        reversal_effects[f"canonical_{column_name}"] = canonical[column_name].to_numpy()
+        reversal_effects[f"reversed_{column_name}"] = reverse[column_name].to_numpy()
+        reversal_effects[f"{column_name}_effect"] = reverse[column_name].to_numpy() - canonical[column_name].to_numpy()
+    return reversal_effects
@@ -0,0 +1,119 @@
+import glob
+import hashlib
+import json
+import os
+
+import torch
+import transformers
+from huggingface_hub import try_to_load_from_cache
+from transformers import AutoConfig
+from transformers.modeling_outputs import BaseModelOutput, CausalLMOutput
+
+from functions.checkpoint import path_name
+from functions.options import BACKENDS, EXPORT_DIR
+
+WEIGHT_FILES = ["model.safetensors", "model.safetensors.index.json", "pytorch_model.bin", "pytorch_model.bin.index.json"]
+
+class LogitsGraph(torch.nn.Module):
+    # (input_ids, attention_mask) -> logits of an LM head model, the traceable part of a minicons scorer
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, return_dict=True).logits
+
+class HiddenStatesGraph(torch.nn.Module):
+    # (input_ids, attention_mask) -> (layers + 1, batch, tokens, hidden) hidden states of a base model
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return torch.stack(self.model(input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=True, return_dict=True).hidden_states)
+
+GRAPHS = {"logits": LogitsGraph, "hidden_states": HiddenStatesGraph}
+
+class ExportedModel(torch.nn.Module):
+    """
+    Stand-in for a Hugging Face model that runs a traced TorchScript graph. Called like the model it replaces
+    and returns .logits (scorer models) or .hidden_states (CWE models). It has no key/value cache and no
+    hookable layers, so prefix caching and early exit fall back to full forward passes.
+    """
+
+    def __init__(self, graph, config, kind : str):
+        super().__init__()
+        self.graph = graph
+        self.config = config
+        self.kind = kind
+
+    @property
+    def device(self):
+        return next(self.graph.parameters(), torch.empty(0)).device
+
+    def forward(self, input_ids = None, attention_mask = None, **kwargs):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        output = self.graph(input_ids, attention_mask)
+        if self.kind == "logits":
+            return CausalLMOutput(logits=output)
+        return BaseModelOutput(last_hidden_state=output[-1], hidden_states=tuple(output))
+
+def weight_files(model_name : str):
+    # the checkpoint's weight files: in a local model directory, or in the Hugging Face cache for hub models
+    if os.path.isdir(model_name):
+        return sorted(glob.glob(os.path.join(model_name, "*.safetensors")) + glob.glob(os.path.join(model_name, "*.bin")))
+    paths = [try_to_load_from_cache(model_name, filename) for filename in WEIGHT_FILES]
+    return [path for path in paths if isinstance(path, str)]
+
+def checkpoint_fingerprint(model_name : str) -> str:
+    # the model's config and the name, size and modification time of its weight files, so a changed checkpoint gets a new graph
+    fingerprint = hashlib.sha256(AutoConfig.from_pretrained(model_name).to_json_string().encode())
+    for path in weight_files(model_name):
+        stat = os.stat(path)
+        fingerprint.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return fingerprint.hexdigest()[:12]
+
+def export_path(export_dir : str, model_name : str, kind : str, precision : str = "fp32"):
+    # one artifact per model checkpoint, graph kind, precision and library versions, since traced graphs are not portable across them
+    return os.path.join(export_dir, path_name(model_name), f"{kind}-{precision}-{checkpoint_fingerprint(model_name)}-torch{torch.__version__}-transformers{transformers.__version__}.pt")
+
+def example_inputs(model):
+    # a padded batch, so the traced graph keeps the attention-mask path
+    input_ids = torch.randint(0, model.config.vocab_size, (2, 8), device=model.device)
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, 5:] = 0
+    return input_ids, attention_mask
+
+def export_model(model, kind : str, path : str):
+    graph = GRAPHS[kind](model).eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(graph, example_inputs(model), strict=False, check_trace=False)
+        try:
+            # fold the weights into the graph so the JIT can fuse ops
+            traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+        except RuntimeError as error:
+            print(f"Could not freeze the traced graph, saving it unfrozen: {error}")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.jit.save(traced, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    with open(os.path.splitext(path)[0] + ".json", "w") as file:
+        json.dump({"kind": kind, "model_type": model.config.model_type, "vocab_size": model.config.vocab_size}, file)
+    return traced
+
+def exported_model(model, model_name : str, kind : str, export_dir : str = EXPORT_DIR, precision : str = "fp32") -> ExportedModel:
+    # load the cached graph for this model, or trace and cache it on first use
+    path = export_path(export_dir, model_name, kind, precision)
+    if os.path.exists(path):
+        graph = torch.jit.load(path, map_location=model.device)
+    else:
+        print(f"Exporting {kind} graph of {model_name} to {path}")
+        graph = export_model(model, kind, path)
+    return ExportedModel(graph, model.config, kind)
+
+def cached_graph(model_name : str, kind : str, export_dir : str = EXPORT_DIR, precision : str = "fp32"):
+    # the cached graph without loading the eager model's weights, or None if it has not been exported yet
+    path = export_path(export_dir, model_name, kind, precision)
+    if not os.path.exists(path):
+        return None
+    return ExportedModel(torch.jit.load(path, map_location="cpu"), AutoConfig.from_pretrained(model_name), kind)
@@ -0,0 +1,129 @@
+import contextlib
+import functools
+import json
+import os
+import resource
+import sys
+import time
+from typing import Optional
+
+import torch
+
+# set ROLEREVERSAL_PROFILE=1 to attach torch.profiler to forward passes, ROLEREVERSAL_TRACE=<path> to write a trace at exit
+PROFILE_ENV = "ROLEREVERSAL_PROFILE"
+TRACE_ENV = "ROLEREVERSAL_TRACE"
+
+_stages = {}
+_counters = {}
+_profiles = {}
+_profiler_enabled = os.environ.get(PROFILE_ENV, "") not in ("", "0")
+_started = time.time()
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def record(name : str, seconds : float, items : int = 0):
+    entry = _stages.setdefault(name, {"calls": 0, "seconds": 0.0, "items": 0, "max_seconds": 0.0})
+    entry["calls"] += 1
+    entry["seconds"] += seconds
+    entry["items"] += items
+    entry["max_seconds"] = max(entry["max_seconds"], seconds)
+
+def count(name : str, n : int = 1):
+    _counters[name] = _counters.get(name, 0) + n
+
+@contextlib.contextmanager
+def stage(name : str, items : int = 0):
+    # wall time of one call of a pipeline stage; items is the number of sentences (or rows, fits, ...) it handled
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, items)
+
+def timed(name : str):
+    # decorator version of stage
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def enable_profiler(enabled : bool = True):
+    global _profiler_enabled
+    _profiler_enabled = enabled
+
+@contextlib.contextmanager
+def forward(name : str, items : int = 0):
+    # a model forward pass: timed like any stage, and run under torch.profiler when profiling is switched on
+    if not _profiler_enabled:
+        with stage(name, items):
+            yield
+        return
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with stage(name, items):
+        with torch.profiler.profile(activities = activities, record_shapes = False) as profiler:
+            yield
+    operators = _profiles.setdefault(name, {})
+    for event in profiler.key_averages():
+        entry = operators.setdefault(event.key, {"calls": 0, "cpu_time_ms": 0.0})
+        entry["calls"] += event.count
+        entry["cpu_time_ms"] += event.cpu_time_total / 1000
+
+def trace(top_operators : int = 20):
+    # structured summary of the run so far
+    memory = {"peak_rss_mb": peak_rss_mb()}
+    if torch.cuda.is_available():
+        memory["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20
+    return {
+        "started": _started,
+        "wall_seconds": time.time() - _started,
+        "argv": sys.argv,
+        "stages": _stages,
+        "counters": _counters,
+        "memory": memory,
+        "profiler": {name: dict(sorted(operators.items(), key = lambda item: -item[1]["cpu_time_ms"])[:top_operators])
+                     for name, operators in _profiles.items()},
+    }
+
+def write_trace(path : Optional[str] = None):
+    path = path or os.environ.get(TRACE_ENV)
+    if not path:
+        return None
+    with open(path + ".tmp", "w") as file:
+        json.dump(trace(), file, indent = 2)
+    os.replace(path + ".tmp", path)
+    print(f"Wrote instrumentation trace to {path}")
+    return path
+
+def collect():
+    # stages, counters and profiles recorded since the last collect, then cleared; worker processes send these to the parent
+    collected = {"stages": dict(_stages), "counters": dict(_counters), "profiles": dict(_profiles)}
+    reset()
+    return collected
+
+def merge(collected : dict):
+    # add what collect() returned in another process to this process's totals
+    for name, entry in collected["stages"].items():
+        total = _stages.setdefault(name, {"calls": 0, "seconds": 0.0, "items": 0, "max_seconds": 0.0})
+        for key in ["calls", "seconds", "items"]:
+            total[key] += entry[key]
+        total["max_seconds"] = max(total["max_seconds"], entry["max_seconds"])
+    for name, n in collected["counters"].items():
+        count(name, n)
+    for name, operators in collected["profiles"].items():
+        for key, entry in operators.items():
+            total = _profiles.setdefault(name, {}).setdefault(key, {"calls": 0, "cpu_time_ms": 0.0})
+            total["calls"] += entry["calls"]
+            total["cpu_time_ms"] += entry["cpu_time_ms"]
+
+def reset():
+    _stages.clear()
+    _counters.clear()
+    _profiles.clear()
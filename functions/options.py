@@ -0,0 +1,45 @@
+import os
+
+# Settings and command line options shared by the scripts, the scoring server and the rolereversal CLI.
+# Only the standard library is imported here, so the CLI can build its parser without loading torch.
+
+PRECISIONS = ["fp32", "bf16", "int8"]
+BACKENDS = ["eager", "torchscript"]
+EXPORT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "rolereversal", "exported")
+
+SCORING_MODELS = ["gpt2", "gpt2-medium", "gpt2-large", "bert-base-uncased", "bert-large-uncased", "roberta-base", "roberta-large"]
+# number of hidden layers of the probed models
+PROBE_LAYERS = {"gpt2": 12, "gpt2-medium": 24, "bert-large-uncased": 24, "roberta-large": 24}
+PROBE_EXPERIMENTS = ["WY_rev", "LE_rev", "KO_rev", "WY_sub", "WY_con", "LE_alt", "KO_con", "WY_LE_rev_comb", "WY_KO_con_comb"]
+# the experiments probed by default
+PROBED_EXPERIMENTS = ["WY_rev", "LE_rev", "KO_rev", "WY_sub"]
+ATTENTION_MODELS = ["gpt2", "roberta-large"]
+
+def add_precision_option(parser):
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32', help='Weights in fp32, bf16, or dynamically quantized int8 Linear layers')
+
+def add_model_options(parser, export_dir : bool = True):
+    add_precision_option(parser)
+    parser.add_argument('--backend', choices=BACKENDS, default='eager', help='Run forward passes in eager PyTorch or a TorchScript graph exported once per model and cached')
+    if export_dir:
+        parser.add_argument('--export-dir', default=EXPORT_DIR, help='Cache directory for exported graphs')
+
+def add_scoring_options(parser):
+    parser.add_argument('--token-budget', type=int, default=8192, help='Maximum padded tokens per scoring forward pass')
+    parser.add_argument('--prefix-cache', action='store_true', help='Reuse the key/value cache of shared sentence prefixes (incremental LMs only)')
+    parser.add_argument('--target-only', action='store_true', help='Only mask and score the target word subtokens (masked LMs only)')
+
+def add_trace_options(parser):
+    parser.add_argument('--trace', default=None, help='Write a JSON trace of per-stage timings and peak memory to this path')
+    parser.add_argument('--profile', action='store_true', help='Run forward passes under torch.profiler (slow; also set by ROLEREVERSAL_PROFILE=1)')
+
+def add_serve_options(parser):
+    parser.add_argument('--models', nargs='+', default=['gpt2'], help='scorer models for /score, should be in minicons')
+    parser.add_argument('--embed-models', nargs='+', default=[], help='models for /embed, loaded as minicons CWE models')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on; keep the default to only accept local clients')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--window-ms', type=float, default=10, help='How long a batch waits for further requests after the first one')
+    parser.add_argument('--max-batch', type=int, default=256, help='Sentences per batch before it runs without waiting for the window')
+    add_scoring_options(parser)
+    add_model_options(parser)
+    parser.add_argument('--offline', action='store_true', help='Only load models from the local Hugging Face cache')
@@ -0,0 +1,31 @@
+import torch
+from transformers.pytorch_utils import Conv1D
+
+from functions.options import PRECISIONS
+
+def conv1d_to_linear(module : torch.nn.Module):
+    # GPT-2 implements its projections as Conv1D (a transposed Linear), which dynamic quantization does not pick up
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            in_features, out_features = child.weight.shape
+            linear = torch.nn.Linear(in_features, out_features)
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            conv1d_to_linear(child)
+    return module
+
+def apply_precision(model : torch.nn.Module, precision : str = "fp32") -> torch.nn.Module:
+    # fp32 leaves the model as is, bf16 casts all weights, int8 dynamically quantizes the Linear layers (CPU only)
+    if precision == "fp32":
+        return model
+    if precision == "bf16":
+        return model.to(torch.bfloat16)
+    if precision == "int8":
+        return torch.ao.quantization.quantize_dynamic(conv1d_to_linear(model), {torch.nn.Linear}, dtype=torch.qint8)
+    raise ValueError(f"Unknown precision: {precision}, expected one of {PRECISIONS}")
+
+def storage_suffix(precision : str = "fp32") -> str:
+    # representation store kinds keep fp32 entries under their old names
+    return "" if precision == "fp32" else f"-{precision}"
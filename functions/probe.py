@@ -7,83 +7,407 @@ Original file is located at
     https://colab.research.google.com/drive/1yHhuSFNMqNtJG2MGp0N_1Cp-WedMwRja
 """
 
-from typing import List
+import functools
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
 import numpy as np
+import pandas as pd
 from minicons import cwe
+from minicons.utils import character_span, find_pattern
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM, AutoModelForMaskedLM
 from sklearn.linear_model import LogisticRegression
-import random
 from sklearn.metrics import accuracy_score
+from scipy.special import expit
+from threadpoolctl import threadpool_limits
+from functions import instrument
+from functions.attention import transformer_layers
+from functions.export import EXPORT_DIR, ExportedModel, cached_graph, exported_model
+from functions.precision import apply_precision, storage_suffix
+from functions.store import RepresentationStore, stimuli_hash
 
-def load_model(model_name):
-    return cwe.CWE(model_name)
+def load_model(model_name, precision : str = "fp32", backend : str = "eager", export_dir : str = EXPORT_DIR):
+    with instrument.stage("load_model"):
+        graph = cached_graph(model_name, "hidden_states", export_dir, precision) if backend == "torchscript" else None
+        if graph is not None:
+            return cached_cwe(model_name, graph)
+        model = cwe.CWE(model_name)
+        model.model = apply_precision(model.model, precision)
+        if backend == "torchscript":
+            model.model = exported_model(model.model, model_name, "hidden_states", export_dir, precision)
+        return model
+
+def cached_cwe(model_name, graph : ExportedModel) -> cwe.CWE:
+    # a CWE around an exported graph, set up like cwe.CWE.__init__ but without loading the eager model's weights
+    model = cwe.CWE.__new__(cwe.CWE)
+    model.device = "cpu"
+    model.pretrained = True
+    model.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    if model.tokenizer.pad_token is None:
+        # the graph was traced after CWE added this token and resized the embeddings
+        model.tokenizer.add_special_tokens({"additional_special_tokens": ["<|pad|>"]})
+        model.tokenizer.pad_token = "<|pad|>"
+    model.model = graph.eval()
+    model.dimensions = graph.config.hidden_size
+    model.layers = graph.config.num_hidden_layers
+    return model
 
 def extract_verb_embeddings(model : cwe.CWE, sentences : List, verbs : List, probe_layer : int):
-    model_input = [pair for pair in zip(sentences, verbs)]
-    verb_embeddings = model.extract_representation(model_input, layer = probe_layer)
-    return verb_embeddings
-
-def extract_sentence_embeddings(model, tokenizer, sentences: List[str], probe_layer: int):
-    # Check if the tokenizer has a padding token
-    if tokenizer.pad_token is None:
-        # If not, set the padding token
-        if 'gpt' in tokenizer.name_or_path:
-            tokenizer.pad_token = tokenizer.eos_token
-        else:
-            tokenizer.add_special_tokens({'pad_token': '[PAD]'})
-    # Modify sentences based on model type
-    if 'gpt' in tokenizer.name_or_path:
+    return torch.from_numpy(extract_verb_embeddings_by_layer(model, sentences, verbs, [probe_layer])[0])
+
+class StopForward(Exception):
+    pass
+
+def layer_hidden_states(model, inputs, probe_layers : List[int]):
+    # hidden states of the requested layers (0 = embeddings), in sorted layer order.
+    # Only runs the blocks up to the highest requested layer and never runs an LM head.
+    if isinstance(model, ExportedModel):
+        # traced graphs have no hookable layers and always return every layer
+        with torch.no_grad():
+            hidden_states = model(**inputs).hidden_states
+        return [hidden_states[layer] for layer in sorted(probe_layers)]
+    base = model.base_model
+    blocks = transformer_layers(model)
+    probe_layers = sorted(probe_layers)
+    max_layer = probe_layers[-1]
+    if max_layer >= len(blocks):
+        # the last hidden state includes the model's final layer norm, so run the whole base model
+        with torch.no_grad():
+            outputs = base(**inputs, output_hidden_states=True)
+        return [outputs.hidden_states[layer] for layer in probe_layers]
+
+    captured = {}
+    def capture_input(module, args, kwargs):
+        captured[0] = args[0] if args else kwargs['hidden_states']
+        if max_layer == 0:
+            raise StopForward
+    def capture_output(layer):
+        def hook(module, args, output):
+            captured[layer] = output[0] if isinstance(output, tuple) else output
+            if layer == max_layer:
+                raise StopForward
+        return hook
+    handles = [blocks[0].register_forward_pre_hook(capture_input, with_kwargs=True)]
+    handles += [blocks[layer - 1].register_forward_hook(capture_output(layer)) for layer in set(probe_layers) if layer > 0]
+    try:
+        with torch.no_grad():
+            base(**inputs)
+    except StopForward:
+        pass
+    finally:
+        for handle in handles:
+            handle.remove()
+    return [captured[layer] for layer in probe_layers]
+
+def extract_verb_embeddings_by_layer(model : cwe.CWE, sentences : List, verbs : List, probe_layers : List[int]):
+    # one (truncated) forward pass for all layers, returns a (layers, sentences, hidden) array in sorted layer order
+    tokenizer = model.tokenizer
+    with instrument.stage("tokenize", len(sentences)):
+        encoded = tokenizer(sentences, padding="longest", return_tensors="pt")
+    instrument.count("embedding_tokens", int(encoded['attention_mask'].sum()))
+    instrument.count("embedding_forward_tokens", encoded['input_ids'].numel())
+    with instrument.forward("embedding_forward", len(sentences)):
+        hidden_states = torch.stack(layer_hidden_states(model.model, encoded, probe_layers))
+    # average the verb's subtokens, locating them the same way as cwe.CWE.extract_representation
+    verb_mask = torch.zeros(encoded['input_ids'].shape)
+    for i, (sentence, verb, input_ids) in enumerate(zip(sentences, verbs, encoded['input_ids'].tolist())):
+        start, end = character_span(sentence, verb)
+        query = sentence[start:end] if start == 0 else f" {sentence[start:end]}"
+        span_start, span_end = find_pattern(tokenizer.encode_plus(query, add_special_tokens=False)["input_ids"], input_ids)
+        verb_mask[i, span_start:span_end] = 1 / max(span_end - span_start, 1)
+    verb_embeddings = torch.einsum('lnth,nt->lnh', hidden_states.float(), verb_mask)
+    return verb_embeddings.numpy()
+
+def cached_verb_embeddings_by_layer(store : RepresentationStore, model_name : str, sentences : List, verbs : List, probe_layers : List[int], load_fn = None,
+                                    precision : str = "fp32"):
+    # read layers from the store, and load the model and run one forward pass only for the missing layers.
+    # Returns a list of (sentences, hidden) memory maps in sorted layer order. A custom load_fn should load the model
+    # at the given precision, which is part of the store key.
+    load_fn = load_fn or functools.partial(load_model, precision=precision)
+    content_hash = stimuli_hash(sentences, verbs)
+    kind = "verb" + storage_suffix(precision)
+    probe_layers = sorted(probe_layers)
+    missing = [layer for layer in probe_layers if not store.contains(model_name, kind, content_hash, layer)]
+    if missing:
+        model = load_fn(model_name)
+        for layer, embeddings in zip(missing, extract_verb_embeddings_by_layer(model, sentences, verbs, missing)):
+            store.put(model_name, kind, content_hash, layer, embeddings)
+    return [store.get(model_name, kind, content_hash, layer) for layer in probe_layers]
+
+def extract_sentence_embeddings(model, tokenizer, sentences: List[str], probe_layer: int, pooling : Optional[str] = None, batch_size : int = 64):
+    return torch.from_numpy(extract_sentence_embeddings_by_layer(model, tokenizer, sentences, [probe_layer], pooling, batch_size)[0])
+
+def pooling_weights(lengths : torch.Tensor, max_length : int, pooling : str):
+    # (batch, tokens) weights that pick the last token ("last"), the first token ("cls") or average the tokens ("mean")
+    positions = torch.arange(max_length)[None, :]
+    if pooling == "last":
+        return (positions == lengths[:, None] - 1).float()
+    if pooling == "cls":
+        return (positions == 0).float().expand(len(lengths), -1)
+    if pooling == "mean":
+        return (positions < lengths[:, None]).float() / lengths[:, None]
+    raise ValueError(f"Unknown pooling: {pooling}")
+
+def extract_sentence_embeddings_by_layer(model, tokenizer, sentences: List[str], probe_layers: List[int], pooling : Optional[str] = None,
+                                         batch_size : int = 64):
+    # Returns a (layers, sentences, hidden) array in sorted layer order. Sentences run in length-sorted batches that are
+    # padded by hand (the tokenizer is left untouched) and each batch is pooled with one weighted sum over its tokens.
+    # By default GPT-like models use the final [EOS] token and BERT-like models the [CLS] token.
+    is_gpt = 'gpt' in tokenizer.name_or_path
+    pooling = pooling or ("last" if is_gpt else "cls")
+    if is_gpt:
         # Add [EOS] token to the beginning and end of each sentence for GPT models
         sentences = [f"{tokenizer.eos_token} {sentence} {tokenizer.eos_token}" for sentence in sentences]
-    elif 'bert' in model.config.model_type:
-        # No modification needed for BERT models, [CLS] token is automatically added by the tokenizer
-        pass
-    # Tokenize the sentences
-    inputs = tokenizer(sentences, return_tensors='pt', padding=True, truncation=True)
-    # Get the model outputs
-    with torch.no_grad():
-        outputs = model(**inputs, output_hidden_states=True)
-    hidden_states = outputs.hidden_states[probe_layer]  # Select the specific layer's hidden states
-    if 'bert' in model.config.model_type:
-        # Use the [CLS] token for BERT-like models
-        sentence_embeddings = hidden_states[:, 0, :]
+    with instrument.stage("tokenize", len(sentences)):
+        input_ids = tokenizer(sentences, truncation=True)['input_ids']
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else (tokenizer.eos_token_id or 0)
+    probe_layers = sorted(probe_layers)
+    lengths = torch.tensor([len(ids) for ids in input_ids])
+    instrument.count("embedding_tokens", int(lengths.sum()))
+    order = torch.argsort(lengths, stable=True)
+    embeddings = None
+    for batch in order.split(batch_size):
+        batch_lengths = lengths[batch]
+        max_length = int(batch_lengths.max())
+        inputs = {
+            'input_ids': torch.tensor([input_ids[i] + [pad_token_id] * (max_length - len(input_ids[i])) for i in batch.tolist()]),
+            'attention_mask': (torch.arange(max_length)[None, :] < batch_lengths[:, None]).long(),
+        }
+        instrument.count("embedding_forward_tokens", len(batch) * max_length)
+        # Get the requested layers' hidden states
+        with instrument.forward("embedding_forward", len(batch)):
+            hidden_states = torch.stack(layer_hidden_states(model, inputs, probe_layers)).float()
+        pooled = torch.einsum('lbth,bt->lbh', hidden_states, pooling_weights(batch_lengths, max_length, pooling))
+        if embeddings is None:
+            embeddings = np.empty((len(probe_layers), len(sentences), pooled.shape[-1]), dtype=np.float32)
+        # write back in the original sentence order
+        embeddings[:, batch.numpy()] = pooled.numpy()
+    if embeddings is None:
+        embeddings = np.empty((len(probe_layers), 0, model.config.hidden_size), dtype=np.float32)
+    return embeddings
+
+def paired_splits(index_length : int, n_splits : int, seed : Optional[int] = None, mode : str = "kfold", n_repeats : int = 1):
+    # items are (plausible, implausible) pairs at positions 2i and 2i+1; both members of a pair always land in the same split.
+    # "kfold" gives n_splits disjoint test folds per repeat, "random" draws each test fold independently.
+    n_pairs = index_length // 2
+    rng = np.random.default_rng(seed)
+    if mode == "kfold":
+        test_pairs = [fold for _ in range(n_repeats) for fold in np.array_split(rng.permutation(n_pairs), n_splits)]
+    elif mode == "random":
+        test_pairs = [rng.choice(n_pairs, size = n_pairs // n_splits, replace = False) for _ in range(n_splits * n_repeats)]
     else:
-        # For GPT-like models, use the last [EOS] token
-        eos_token_id = tokenizer.eos_token_id
-        eos_token_embeddings = []
-        for i, input_id in enumerate(inputs['input_ids']):
-            eos_token_indices = (input_id == eos_token_id).nonzero(as_tuple=True)[0]
-            eos_token_index = eos_token_indices[-1].item()  # Use the last occurrence of the EOS token
-            eos_token_embeddings.append(hidden_states[i, eos_token_index, :])
-        sentence_embeddings = torch.stack(eos_token_embeddings)
-    return sentence_embeddings
-
-def controlled_KFold(index_length, n_splits):
-    indices = range(index_length)
-    trains = []
-    tests = []
-    for i in range(n_splits):
-      i = 0
-      targets = random.sample(range(int(index_length/2)), int(index_length/n_splits/2))
-      targets = [i*2 for i in targets] + [i*2+1 for i in targets]
-      targets.sort()
-      tests.append(np.array(targets))
-      trains.append(np.array([i for i in range(index_length) if i not in targets]))
+        raise ValueError(f"Unknown split mode: {mode}")
+    is_test = np.zeros((len(test_pairs), n_pairs), dtype = bool)
+    for fold, pairs in enumerate(test_pairs):
+        is_test[fold, pairs] = True
+    is_test = np.repeat(is_test, 2, axis = 1)
+    trains = [np.flatnonzero(~mask) for mask in is_test]
+    tests = [np.flatnonzero(mask) for mask in is_test]
     return trains, tests
 
-def run_probing(embeddings : List, labels : List):
+def controlled_KFold(index_length, n_splits, seed = None):
+    return paired_splits(index_length, n_splits, seed, mode = "random")
+
+def fit_fold(X_train, y_train, X_test, y_test):
+    model = LogisticRegression(max_iter = 500, solver = "liblinear")
+    with instrument.stage("probe_fit", 1):
+        model.fit(X_train, y_train)
+    test_pred = model.predict(X_test)
+    return accuracy_score(y_test, test_pred)
+
+def run_probing(embeddings : List, labels : List, n_splits : int = 10, seed : Optional[int] = None, mode : str = "kfold"):
     x = embeddings
     y = np.array(labels)
     accuracies = []
-    train_indices, test_indices = controlled_KFold(120, 10)
-    for fold in range(10):
+    train_indices, test_indices = paired_splits(len(y), n_splits, seed, mode)
+    for fold in range(len(train_indices)):
         train_index = train_indices[fold]
         test_index = test_indices[fold]
-        model = LogisticRegression(max_iter = 500, solver = "liblinear")
         X_train, X_test = x[train_index], x[test_index]
         y_train, y_test = y[train_index], y[test_index]
-        model.fit(X_train, y_train)
-        test_pred = model.predict(X_test)
-        accuracies.append(accuracy_score(y_test, test_pred))
+        accuracies.append(fit_fold(X_train, y_train, X_test, y_test))
     return accuracies
+
+_thread_limits = None
+_probe_data = None
+
+def limit_worker_threads(blas_threads : int):
+    # keep each worker to its share of the cores; the limiter is kept alive for the worker's lifetime
+    global _thread_limits
+    _thread_limits = threadpool_limits(limits = blas_threads)
+    torch.set_num_threads(blas_threads)
+
+def init_probe_worker(layer_embeddings, labels : np.ndarray, splits, blas_threads : int = 1):
+    # the pool is forked, so workers share the (memory-mapped) embeddings instead of receiving pickled copies
+    global _probe_data
+    _probe_data = (layer_embeddings, labels, splits)
+    limit_worker_threads(blas_threads)
+    # the parent already has the stages it recorded before the fork
+    instrument.reset()
+
+def fit_fold_task(task):
+    # a (layer, fold) pair; the worker slices the train and test rows out of the layer's embeddings itself
+    layer, fold = task
+    layer_embeddings, y, (train_indices, test_indices) = _probe_data
+    x, train_index, test_index = layer_embeddings[layer], train_indices[fold], test_indices[fold]
+    return fit_fold(np.asarray(x[train_index]), y[train_index], np.asarray(x[test_index]), y[test_index])
+
+def fit_fold_pooled(task):
+    # fit_fold_task in a pool worker, sending its stages back with the accuracy
+    return fit_fold_task(task), instrument.collect()
+
+def run_layer_probing(layer_embeddings, labels : List, n_splits : int = 10, seed : Optional[int] = None, mode : str = "kfold",
+                      n_jobs : Optional[int] = None, blas_threads : int = 1):
+    # fit every (layer, fold) probe of an experiment in a process pool; returns one list of fold accuracies per layer.
+    # All layers share the same folds.
+    global _probe_data
+    y = np.array(labels)
+    splits = paired_splits(len(y), n_splits, seed, mode)
+    n_folds = len(splits[0])
+    tasks = [(layer, fold) for layer in range(len(layer_embeddings)) for fold in range(n_folds)]
+    n_jobs = n_jobs or max(1, (os.cpu_count() or 1) // blas_threads)
+    if n_jobs == 1:
+        _probe_data = (layer_embeddings, y, splits)
+        try:
+            accuracies = [fit_fold_task(task) for task in tasks]
+        finally:
+            _probe_data = None
+    else:
+        with instrument.stage("probe_fit_pool", len(tasks)), \
+             ProcessPoolExecutor(max_workers = min(n_jobs, len(tasks)), mp_context = multiprocessing.get_context("fork"),
+                                 initializer = init_probe_worker, initargs = (layer_embeddings, y, splits, blas_threads)) as executor:
+            accuracies = []
+            for accuracy, collected in executor.map(fit_fold_pooled, tasks, chunksize = max(1, len(tasks) // (4 * n_jobs))):
+                accuracies.append(accuracy)
+                instrument.merge(collected)
+    return [accuracies[i:i + n_folds] for i in range(0, len(accuracies), n_folds)]
+
+def fit_logistic_batch(K : np.ndarray, Y : np.ndarray, C : float = 1.0, A0 : Optional[np.ndarray] = None, max_iter : int = 500, tol : float = 1e-5):
+    # Fits one L2-regularized logistic regression per column of Y (liblinear's objective, intercept penalized)
+    # with accelerated gradient descent. K is the train Gram matrix of the (intercept-augmented) features and the
+    # weights are returned as dual coefficients A, w = X.T @ A, so the cost per step is n x n x columns.
+    n = K.shape[0]
+    lam = 1 / (C * n)
+    step = 1 / (np.linalg.eigvalsh(K)[-1] / (4 * n) + lam)
+    A = np.zeros(Y.shape) if A0 is None else A0.copy()
+    Z, t = A.copy(), 1.0
+    for _ in range(max_iter):
+        grad = (expit(K @ Z) - Y) / n + lam * Z
+        A_next = Z - step * grad
+        t_next = (1 + np.sqrt(1 + 4 * t * t)) / 2
+        Z = A_next + (t - 1) / t_next * (A_next - A)
+        A, t = A_next, t_next
+        if np.abs(grad).max() < tol:
+            break
+    return A
+
+def permuted_labels(labels : List, n_permutations : int, rng : np.random.Generator):
+    # column 0 holds the true labels; the other columns swap the labels within randomly chosen pairs,
+    # so every permutation keeps one plausible and one implausible item per pair
+    pairs = np.array(labels).reshape(-1, 2)
+    flips = rng.random((len(pairs), n_permutations)) < 0.5
+    flips = np.concatenate([np.zeros((len(pairs), 1), dtype = bool), flips], axis = 1)
+    first = np.where(flips, pairs[:, 1:2], pairs[:, 0:1])
+    second = np.where(flips, pairs[:, 0:1], pairs[:, 1:2])
+    return np.stack([first, second], axis = 1).reshape(-1, n_permutations + 1)
+
+def permutation_baseline(layer_embeddings, labels : List, n_permutations : int = 1000, n_splits : int = 10, seed : Optional[int] = None,
+                         mode : str = "kfold", C : float = 1.0, max_iter : int = 500):
+    # Shuffled-label baseline for every layer: the true labels and all permutations are fit together per fold,
+    # on the same splits as run_layer_probing with the same seed. Returns per-layer observed accuracy, null
+    # distribution and p-value; solvers are warm-started from the previous layer's solution for each fold.
+    return list(iter_permutation_baseline(layer_embeddings, labels, n_permutations, n_splits, seed, mode, C, max_iter))
+
+def iter_permutation_baseline(layer_embeddings, labels : List, n_permutations : int = 1000, n_splits : int = 10, seed : Optional[int] = None,
+                              mode : str = "kfold", C : float = 1.0, max_iter : int = 500):
+    # permutation_baseline one layer at a time, so callers can checkpoint between layers
+    train_indices, test_indices = paired_splits(len(labels), n_splits, seed, mode)
+    Y = permuted_labels(labels, n_permutations, np.random.default_rng(seed))
+    warm_starts = [None] * len(train_indices)
+    for x in layer_embeddings:
+        x = np.asarray(x, dtype = np.float64)
+        correct = np.zeros(n_permutations + 1)
+        for fold, (train_index, test_index) in enumerate(zip(train_indices, test_indices)):
+            mean, std = x[train_index].mean(0), x[train_index].std(0) + 1e-8
+            X_train = np.hstack([(x[train_index] - mean) / std, np.ones((len(train_index), 1))])
+            X_test = np.hstack([(x[test_index] - mean) / std, np.ones((len(test_index), 1))])
+            with instrument.stage("permutation_fit", Y.shape[1]):
+                A = fit_logistic_batch(X_train @ X_train.T, Y[train_index], C, warm_starts[fold], max_iter)
+            warm_starts[fold] = A
+            test_pred = (X_test @ X_train.T @ A) > 0
+            correct += (test_pred == Y[test_index]).sum(0)
+        accuracy = correct / sum(len(test_index) for test_index in test_indices)
+        observed, null = accuracy[0], accuracy[1:]
+        yield {
+            "accuracy": float(observed),
+            "p_value": float((1 + (null >= observed).sum()) / (n_permutations + 1)),
+            "null": null.tolist(),
+        }
+
+def split_hash(labels : List, n_splits : int = 10, seed : Optional[int] = None, mode : str = "kfold", n_permutations : int = 0) -> str:
+    # fingerprint of the folds (and permuted labels) a seed produces, so a resumed run can check it gets the same ones
+    _, tests = paired_splits(len(labels), n_splits, seed, mode)
+    digest = hashlib.sha256()
+    for test_index in tests:
+        digest.update(test_index.tobytes())
+    if n_permutations:
+        digest.update(permuted_labels(labels, n_permutations, np.random.default_rng(seed)).tobytes())
+    return digest.hexdigest()
+
+def paired_stimuli(df_raw : pd.DataFrame) -> pd.DataFrame:
+    # one row per (exp, item, type) with the plausible and implausible sentence and target side by side
+    # Melt the DataFrame
+    melted_sentence = df_raw.melt(id_vars=["exp","item", "type", "plausibility"], value_vars=["sentence"], var_name="variable", value_name="sentences")
+    # Pivot the DataFrame to get implaus_sent and plaus_sent columns
+    pivoted_sentence = melted_sentence.pivot_table(index=["exp","item","type"], columns="plausibility", values="sentences", aggfunc='first').reset_index()
+    pivoted_sentence.columns = ["exp","item", "type","implaus_sent", "plaus_sent"]
+
+    # Melt the DataFrame
+    melted_target = df_raw.melt(id_vars=["exp","item", "type", "plausibility"], value_vars=["target"], var_name="variable", value_name="targets")
+    # Pivot the DataFrame to get implaus_target and plaus_target columns
+    pivoted_target = melted_target.pivot_table(index=["exp","item","type"], columns="plausibility", values="targets", aggfunc='first').reset_index()
+    pivoted_target.columns = ["exp","item", "type","implaus_target", "plaus_target"]
+
+    df_temp = pd.merge(pivoted_sentence,df_raw[["exp","item", "type"]],how='left',on=["exp","item", "type"]).drop_duplicates()
+    return pd.merge(pivoted_target,df_temp[["exp","item", "type",'implaus_sent','plaus_sent']],how='left',on=["exp","item", "type"]).drop_duplicates()
+
+def probe_experiments(df : pd.DataFrame) -> dict:
+    # the experiment subsets of the paired stimuli, by experiment name
+    experiments = {
+        "WY_rev": df[(df['exp'] == 'WY') & (df['type'] == 'reversal')],
+        "LE_rev": df[(df['exp'] == 'LE') & (df['type'] == 'reversal')],
+        "KO_rev": df[(df['exp'] == 'KO') & (df['type'] == 'reversal')],
+        "WY_sub": df[(df['exp'] == 'WY') & (df['type'] == 'substitution')],
+        "WY_con": df[(df['exp'] == 'WY') & (df['type'] == 'control')],
+        "LE_alt": df[(df['exp'] == 'LE') & (df['type'] == 'alternative')],
+        "KO_con": df[(df['exp'] == 'KO') & (df['type'] == 'control')],
+    }
+    experiments["WY_LE_rev_comb"] = pd.concat([experiments["WY_rev"], experiments["LE_rev"]], ignore_index=True)
+    experiments["WY_KO_con_comb"] = pd.concat([experiments["WY_con"], experiments["KO_con"]], ignore_index=True)
+    return experiments
+
+def prep_fn(row):
+    stimuli = [f"{row['plaus_sent']}",
+               f"{row['implaus_sent']}"]
+    labels = [0, 1]  # plausible is 0, implausible is 1
+    verbs = [f"{row['plaus_target']}",
+             f"{row['implaus_target']}"]
+    return stimuli, labels, verbs
+
+def check_stimuli_contains_verb(stimuli, verbs):
+    for stimulus, verb in zip(stimuli, verbs):
+        if verb not in stimulus:
+            print(f"Error: Verb '{verb}' not found in stimulus '{stimulus}'")
+
+def process_data(df, prep_fn = prep_fn):
+    stimuli, labels, verbs = [], [], []
+    for _, row in df.iterrows():
+        row_stimuli, row_labels, row_verbs = prep_fn(row)
+        check_stimuli_contains_verb(row_stimuli, row_verbs)
+        stimuli += row_stimuli
+        labels += row_labels
+        verbs += row_verbs
+    return stimuli, labels, verbs
@@ -0,0 +1,100 @@
+import multiprocessing
+import os
+import queue
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import torch
+from threadpoolctl import threadpool_limits
+
+from functions import instrument
+
+_jobs = None
+_results = None
+_threads = None
+_thread_limits = None
+
+def expand_jobs(model_names : List[str], job_keys : List) -> Dict[str, List]:
+    # the full sweep as one job list per model, so a model is loaded once for all of its jobs
+    return {model_name: list(job_keys) for model_name in model_names}
+
+def thread_budget(n_workers : int, cpu_count : Optional[int] = None) -> int:
+    return max(1, (cpu_count or os.cpu_count() or 1) // n_workers)
+
+def init_worker(threads : int, results, jobs : Optional[Dict[str, List]] = None):
+    # pin each worker to its share of the cores (torch intra-op and BLAS pools) and keep the result queue and the job lists,
+    # which a forked worker shares with the parent instead of receiving them pickled
+    global _jobs, _results, _threads, _thread_limits
+    _jobs = jobs
+    _results = results
+    _threads = threads
+    _thread_limits = threadpool_limits(limits = threads)
+    torch.set_num_threads(threads)
+
+def worker_threads() -> int:
+    # the cores a job may use: its worker's share inside run_jobs, all of them elsewhere
+    return _threads or os.cpu_count() or 1
+
+def run_model_jobs(model_name : str, load_fn : Callable, job_fn : Callable):
+    # worker side: load the model once, then hand every job's result, with the stages timed for it, to the parent as soon as it is done;
+    # the parent already has the stages it recorded before the fork, a worker only reports its own
+    instrument.reset()
+    model = load_fn(model_name)
+    for index, job in enumerate(_jobs[model_name]):
+        result = job_fn(model, model_name, job)
+        _results.put((model_name, index, result, instrument.collect()))
+    return len(_jobs[model_name])
+
+def stop_workers(executor : ProcessPoolExecutor, results):
+    # workers may be mid-model or blocked writing to the queue; kill them so leaving the pool does not wait for them
+    processes = list((executor._processes or {}).values())
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+    executor.shutdown(wait = True, cancel_futures = True)
+    results.close()
+    results.cancel_join_thread()
+
+def run_jobs(jobs : Dict[str, List], load_fn : Callable, job_fn : Callable, on_result : Callable,
+             n_workers : Optional[int] = None, threads_per_worker : Optional[int] = None):
+    """
+    Runs a sweep given as {model name: [job, ...]} in a process pool with one task per model.
+    Each worker calls load_fn(model_name) once and job_fn(model, model_name, job) for each of its jobs;
+    on_result(model_name, job, result) runs in the parent as results arrive, so they can be written out
+    while other workers are still busy. load_fn and job_fn must be module-level functions.
+    """
+    n_workers = min(n_workers or os.cpu_count() or 1, len(jobs))
+    threads = threads_per_worker or thread_budget(n_workers)
+    print(f"Scheduling {sum(len(model_jobs) for model_jobs in jobs.values())} jobs for {len(jobs)} models on {n_workers} workers with {threads} threads each")
+    # fast tokenizers disable their own thread pool after a fork anyway; say so up front instead of warning per worker
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    if n_workers == 1:
+        init_worker(threads, results)
+        for model_name, model_jobs in jobs.items():
+            model = load_fn(model_name)
+            for job in model_jobs:
+                on_result(model_name, job, job_fn(model, model_name, job))
+            del model
+        return
+    with ProcessPoolExecutor(max_workers = n_workers, mp_context = context, initializer = init_worker, initargs = (threads, results, jobs)) as executor:
+        try:
+            futures = [executor.submit(run_model_jobs, model_name, load_fn, job_fn) for model_name in jobs]
+            remaining = sum(len(model_jobs) for model_jobs in jobs.values())
+            while remaining:
+                try:
+                    model_name, index, result, collected = results.get(timeout = 1)
+                except queue.Empty:
+                    # surface worker failures instead of waiting for results that will never come
+                    for future in futures:
+                        if future.done() and future.exception() is not None:
+                            raise future.exception()
+                    continue
+                instrument.merge(collected)
+                on_result(model_name, jobs[model_name][index], result)
+                remaining -= 1
+        except BaseException:
+            stop_workers(executor, results)
+            raise
@@ -0,0 +1,230 @@
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Hashable, List, Optional
+
+from functions import instrument
+from functions.probe import extract_sentence_embeddings_by_layer
+from functions.surprisal import surprisal_at_word
+
+# None picks the model's default, see extract_sentence_embeddings_by_layer
+POOLINGS = [None, "last", "cls", "mean"]
+
+class UnknownModel(Exception):
+    # a request for a model the server has not loaded, answered with a 404
+    pass
+
+class BatchFailed(Exception):
+    # an error raised while running a request's batch, answered with a 500 whatever its type
+    pass
+
+class Batcher:
+    """
+    Coalesces concurrent requests for one model into batches. A request is a key and a list of items; the requests
+    that arrive within `window` seconds of the first one (up to `max_items` items) are grouped by key and each group
+    runs as one batch_fn(key, items) call. Batches run on the batcher's own thread, the only one that uses the model.
+    """
+
+    def __init__(self, batch_fn : Callable, window : float = 0.01, max_items : int = 256):
+        self.batch_fn = batch_fn
+        self.window = window
+        self.max_items = max_items
+        self.requests = queue.Queue()
+        self.stats = {"requests": 0, "batches": 0, "items": 0, "max_batch_items": 0}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, key : Hashable, items : List) -> Future:
+        future = Future()
+        self.requests.put((key, list(items), future))
+        return future
+
+    def collect(self):
+        # block for the first request, then take whatever else arrives until the window closes or the batch is full
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        n_items = len(first[1])
+        deadline = time.perf_counter() + self.window
+        while n_items < self.max_items:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # finish this batch first, then stop
+                self.requests.put(None)
+                break
+            batch.append(request)
+            n_items += len(request[1])
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            if batch is None:
+                return
+            for key in dict.fromkeys(key for key, _, _ in batch):
+                self.run_batch(key, [request for request in batch if request[0] == key])
+
+    def run_batch(self, key : Hashable, requests : List):
+        items = [item for _, request_items, _ in requests for item in request_items]
+        try:
+            with instrument.stage("server_batch", len(items)):
+                results = self.batch_fn(key, items)
+        except Exception as error:
+            if len(requests) == 1:
+                requests[0][2].set_exception(error)
+                return
+            # one request's bad input should not fail the others it was batched with, so each runs on its own
+            for request in requests:
+                self.run_batch(key, [request])
+            return
+        self.stats["requests"] += len(requests)
+        self.stats["batches"] += 1
+        self.stats["items"] += len(items)
+        self.stats["max_batch_items"] = max(self.stats["max_batch_items"], len(items))
+        start = 0
+        for _, request_items, future in requests:
+            future.set_result(results[start:start + len(request_items)])
+            start += len(request_items)
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+def score_batch_fn(model, model_name : str, token_budget : Optional[int] = 8192, prefix_cache : bool = False, target_only : bool = False):
+    # items are (sentence, target) pairs; uncased models see lowercased sentences, as in the scoring scripts
+    def batch_fn(key, items):
+        sentences = [sentence.lower() if 'uncased' in model_name else sentence for sentence, _ in items]
+        targets = [target for _, target in items]
+        return surprisal_at_word(model, sentences, targets, token_budget, prefix_cache, target_only)
+    return batch_fn
+
+def embed_batch_fn(model):
+    # items are sentences and the key is (layers, pooling); returns one (layers, hidden) array per sentence
+    def batch_fn(key, items):
+        layers, pooling = key
+        return list(extract_sentence_embeddings_by_layer(model.model, model.tokenizer, items, list(layers), pooling).transpose(1, 0, 2))
+    return batch_fn
+
+class ScoringServer(ThreadingHTTPServer):
+    """
+    HTTP server that keeps scorer models (minicons scorers, for /score) and CWE models (for /embed) loaded,
+    with one Batcher per model. Each connection is handled on its own thread and waits for its batch.
+    """
+
+    daemon_threads = True
+    # clients that want their requests batched connect at once; the default backlog of 5 resets their connections
+    request_queue_size = 128
+
+    def __init__(self, address, scorers : Dict, embedders : Dict, window : float = 0.01, max_items : int = 256, token_budget : Optional[int] = 8192,
+                 prefix_cache : bool = False, target_only : bool = False, timeout : float = 300):
+        super().__init__(address, ScoringHandler)
+        self.timeout_seconds = timeout
+        self.scorers = {model_name: Batcher(score_batch_fn(model, model_name, token_budget, prefix_cache, target_only), window, max_items)
+                        for model_name, model in scorers.items()}
+        self.embedders = {model_name: Batcher(embed_batch_fn(model), window, max_items) for model_name, model in embedders.items()}
+        # valid /embed layers are 0 (embeddings) to the number of transformer layers
+        self.embed_layers = {model_name: model.layers for model_name, model in embedders.items()}
+
+    def score(self, payload : dict):
+        sentences, targets = payload.get("sentences"), payload.get("targets")
+        if not isinstance(sentences, list) or not isinstance(targets, list) or len(sentences) != len(targets):
+            raise ValueError("expected equally long 'sentences' and 'targets' lists")
+        # checked before batching, where a bad item would fail the other clients' requests too
+        if not all(isinstance(item, str) for item in sentences + targets):
+            raise ValueError("'sentences' and 'targets' must be lists of strings")
+        batcher = self.batcher(self.scorers, payload)
+        surprisals = self.wait(batcher.submit(None, zip(sentences, targets)))
+        return {"model": payload["model"], "surprisals": [float(value) for value in surprisals]}
+
+    def embed(self, payload : dict):
+        sentences, layers = payload.get("sentences"), payload.get("layers")
+        if not isinstance(sentences, list) or not isinstance(layers, list) or not layers:
+            raise ValueError("expected a 'sentences' list and a non-empty 'layers' list")
+        if payload.get("pooling") not in POOLINGS:
+            raise ValueError(f"unknown pooling {payload.get('pooling')!r}, expected one of {POOLINGS}")
+        if not all(isinstance(sentence, str) for sentence in sentences):
+            raise ValueError("'sentences' must be a list of strings")
+        if not all(isinstance(layer, int) and not isinstance(layer, bool) for layer in layers):
+            raise ValueError("'layers' must be a list of integers")
+        batcher = self.batcher(self.embedders, payload)
+        # checked before batching, where an out-of-range layer would fail the other clients' requests and a negative one index from the end
+        n_layers = self.embed_layers[payload["model"]]
+        if not all(0 <= layer <= n_layers for layer in layers):
+            raise ValueError(f"'layers' must be between 0 and {n_layers} for {payload['model']}")
+        layers = sorted(layers)
+        embeddings = self.wait(batcher.submit((tuple(layers), payload.get("pooling")), sentences))
+        return {"model": payload["model"], "layers": layers, "embeddings": [embedding.tolist() for embedding in embeddings]}
+
+    def wait(self, future : Future):
+        # requests are validated before batching, so anything raised by the batch itself is a server error
+        try:
+            return future.result(self.timeout_seconds)
+        except Exception as error:
+            raise BatchFailed(f"{type(error).__name__}: {error}") from error
+
+    def batcher(self, batchers : Dict, payload : dict) -> Batcher:
+        if payload.get("model") not in batchers:
+            raise UnknownModel(f"model {payload.get('model')!r} is not loaded, available: {sorted(batchers)}")
+        return batchers[payload["model"]]
+
+    def health(self):
+        return {
+            "scorers": {model_name: batcher.stats for model_name, batcher in self.scorers.items()},
+            "embedders": {model_name: batcher.stats for model_name, batcher in self.embedders.items()},
+            "stages": instrument.trace()["stages"],
+        }
+
+    def server_close(self):
+        super().server_close()
+        for batcher in list(self.scorers.values()) + list(self.embedders.values()):
+            batcher.close()
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    # POST /score {"model", "sentences", "targets"}, POST /embed {"model", "sentences", "layers", "pooling"}, GET /health
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.reply(200, self.server.health())
+        else:
+            self.reply(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        routes = {"/score": self.server.score, "/embed": self.server.embed}
+        if self.path not in routes:
+            self.reply(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if not isinstance(payload, dict):
+                raise ValueError("expected a JSON object")
+            self.reply(200, routes[self.path](payload))
+        except UnknownModel as error:
+            self.reply(404, {"error": str(error)})
+        except ValueError as error:
+            self.reply(400, {"error": str(error)})
+        except BatchFailed as error:
+            self.reply(500, {"error": str(error)})
+        except Exception as error:
+            self.reply(500, {"error": f"{type(error).__name__}: {error}"})
+
+    def reply(self, status : int, body : dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # per-request logging would dominate the output of a busy server
+        pass
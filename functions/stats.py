@@ -0,0 +1,54 @@
+import warnings
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+def effect_columns(effects : pd.DataFrame) -> List[str]:
+    return [column for column in effects.columns if column.endswith("_effect")]
+
+def resampling_draws(n_resamples : int, max_items : int, seed : Optional[int] = 0):
+    # uniform draws for bootstrap indices and random signs, drawn once and shared by every group and model
+    rng = np.random.default_rng(seed)
+    uniforms = rng.random((n_resamples, max_items))
+    signs = rng.choice(np.array([-1.0, 1.0]), size = (n_resamples, max_items))
+    return uniforms, signs
+
+def group_statistics(values : np.ndarray, uniforms : np.ndarray, signs : np.ndarray, ci : float = 0.95):
+    # values: (items, models) effects with NaN for missing scores; returns mean, CI bounds and two-sided p-value per model
+    n_items = len(values)
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0.0)
+    counts = valid.sum(axis = 0)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        observed = filled.sum(axis = 0) / counts
+        # bootstrap: one gather of resampled item rows for all models at once, (resamples, items, models)
+        indices = (uniforms[:, :n_items] * n_items).astype(int)
+        boot_means = filled[indices].sum(axis = 1) / valid[indices].sum(axis = 1)
+        # sign-flip permutation test of a zero mean effect
+        null_means = (signs[:, :n_items] @ filled) / counts
+    alpha = (1 - ci) / 2
+    with warnings.catch_warnings():
+        # models without scores for this group (all NaN) get NaN statistics
+        warnings.simplefilter("ignore", RuntimeWarning)
+        ci_low, ci_high = np.nanquantile(boot_means, [alpha, 1 - alpha], axis = 0)
+    exceed = (np.abs(null_means) >= np.abs(observed) - 1e-12).sum(axis = 0)
+    p_values = np.where(counts > 0, (exceed + 1) / (len(signs) + 1), np.nan)
+    return observed, ci_low, ci_high, p_values, counts
+
+def effect_statistics(effects : pd.DataFrame, group_cols : List[str] = ["expt", "condition"], n_resamples : int = 10000,
+                      ci : float = 0.95, seed : Optional[int] = 0) -> pd.DataFrame:
+    # item-level bootstrap CIs and sign-flip permutation p-values for every model x condition x experiment
+    columns = effect_columns(effects)
+    groups = effects.groupby(group_cols, sort = False).indices
+    uniforms, signs = resampling_draws(n_resamples, max(len(positions) for positions in groups.values()), seed)
+    values = effects[columns].to_numpy(dtype = float)
+    rows = []
+    for group, positions in groups.items():
+        group = group if isinstance(group, tuple) else (group,)
+        for column, *statistics in zip(columns, *group_statistics(values[positions], uniforms, signs, ci)):
+            row = dict(zip(group_cols, group))
+            row["model"] = column.split("_surprisal")[0]
+            row.update(zip(["mean_effect", "ci_low", "ci_high", "p_value", "n_items"], statistics))
+            rows.append(row)
+    return pd.DataFrame(rows)
@@ -0,0 +1,79 @@
+import fcntl
+import hashlib
+import json
+import os
+from typing import List, Optional
+
+import numpy as np
+
+def stimuli_hash(*columns : List[str]):
+    # content hash of the stimuli (e.g. sentences and verbs), so edited stimulus files get new entries
+    digest = hashlib.sha256()
+    for column in columns:
+        digest.update(json.dumps(list(column)).encode("utf-8"))
+    return digest.hexdigest()
+
+class RepresentationStore:
+    """
+    On-disk store of hidden-state arrays saved as .npy files and read back as memory maps.
+    Entries are keyed by model name, representation kind, stimulus hash and layer,
+    and listed in a small JSON index in the store directory.
+    """
+
+    def __init__(self, root : str, dtype : str = "float32"):
+        self.root = root
+        self.dtype = np.dtype(dtype)
+        self.index_path = os.path.join(root, "index.json")
+        os.makedirs(root, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as file:
+                self.index = json.load(file)
+        else:
+            self.index = {}
+
+    @staticmethod
+    def key(model_name : str, kind : str, content_hash : str, layer : int):
+        return f"{model_name}|{kind}|{content_hash}|{layer}"
+
+    def contains(self, model_name : str, kind : str, content_hash : str, layer : int):
+        entry = self.index.get(self.key(model_name, kind, content_hash, layer))
+        return entry is not None and os.path.exists(os.path.join(self.root, entry["file"]))
+
+    def get(self, model_name : str, kind : str, content_hash : str, layer : int) -> Optional[np.ndarray]:
+        if not self.contains(model_name, kind, content_hash, layer):
+            return None
+        entry = self.index[self.key(model_name, kind, content_hash, layer)]
+        return np.load(os.path.join(self.root, entry["file"]), mmap_mode="r")
+
+    def put(self, model_name : str, kind : str, content_hash : str, layer : int, array : np.ndarray):
+        key = self.key(model_name, kind, content_hash, layer)
+        filename = hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npy"
+        path = os.path.join(self.root, filename)
+        # write to a temporary file first so a crash never leaves a truncated array behind
+        stored = np.lib.format.open_memmap(path + ".tmp", mode="w+", dtype=self.dtype, shape=array.shape)
+        stored[:] = array
+        stored.flush()
+        del stored
+        os.replace(path + ".tmp", path)
+        self._update_index(key, {
+            "model": model_name,
+            "kind": kind,
+            "stimuli_hash": content_hash,
+            "layer": layer,
+            "file": filename,
+            "shape": list(array.shape),
+            "dtype": self.dtype.name,
+        })
+        return self.get(model_name, kind, content_hash, layer)
+
+    def _update_index(self, key : str, entry : dict):
+        # several processes may write to one store: merge with the index on disk under an exclusive lock
+        with open(self.index_path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(self.index_path):
+                with open(self.index_path, "r") as file:
+                    self.index.update(json.load(file))
+            self.index[key] = entry
+            with open(self.index_path + ".tmp", "w") as file:
+                json.dump(self.index, file, indent=2)
+            os.replace(self.index_path + ".tmp", self.index_path)
@@ -1,97 +1,321 @@
 import numpy as np
 import pandas as pd
-from typing import List, Tuple
-
-def surprisal_at_word(model, sentences : List, target_tokens : List):
-    tokenwise_surprisals = model.token_score(sentences, surprisal = True, base_two = True)
-    critical_surprisal = []
-    for scores, sentence, target_tokens in zip(tokenwise_surprisals, sentences, target_tokens):
-        try:
-            word_surprisals = align_surprisal(scores, sentence)
-            target_surprisal = 0
-            target_list = target_tokens.split(" ")
-            for word, surprisal in word_surprisals:
-                if word in target_list:
-                    target_surprisal += surprisal
-        except IndexError:
-            target_surprisal = -1
-            import pdb; pdb.set_trace()
-            print(f"Failed to compute surprisal for sentence {sentence} with scores {scores}")
-        critical_surprisal.append(target_surprisal)
-    return critical_surprisal
+import torch
+from typing import Iterator, List, Optional, Tuple
+
+from functions import instrument
+from functions.effects import get_sentence_data, reversal_surprisal_effect, surprisal_effects
+from functions.export import ExportedModel
+
+def surprisal_at_word(model, sentences : List, target_tokens : List, token_budget : Optional[int] = 8192, prefix_cache : bool = False,
+                      target_only : bool = False):
+    return list(stream_surprisal_at_word(model, sentences, target_tokens, token_budget, prefix_cache, target_only))
+
+def stream_surprisal_at_word(model, sentences : List, target_tokens : List, token_budget : Optional[int] = 8192,
+                             prefix_cache : bool = False, target_only : bool = False) -> Iterator[float]:
+    # scores length-sorted batches that fit the token budget and yields target surprisals in the original order.
+    # With prefix_cache, incremental LMs run each shared token prefix once, batching many prefix groups per forward pass.
+    # With target_only, masked LMs only mask the subtokens of the target words.
+    if target_only and hasattr(model, "mask_token_id"):
+        yield from stream_masked_target_surprisal(model, sentences, target_tokens, token_budget)
+        return
+    with instrument.stage("tokenize", len(sentences)):
+        input_ids = model.tokenizer(sentences)['input_ids']
+    lengths = [len(ids) for ids in input_ids]
+    instrument.count("surprisal_tokens", sum(lengths))
+    if isinstance(model.model, ExportedModel):
+        # exported graphs have no key/value cache
+        prefix_cache = False
+    if hasattr(model, "mask_token_id"):
+        # masked LMs score a sentence with one masked copy per token
+        prefix_cache = False
+        costs = [length * length for length in lengths]
+        # minicons masks every token except [CLS], [SEP] and padding
+        special = {model.tokenizer.cls_token_id, model.tokenizer.sep_token_id, model.tokenizer.pad_token_id}
+        copies = [sum(token not in special for token in ids) for ids in input_ids]
+    else:
+        costs = lengths
+        copies = [1] * len(input_ids)
+    order = np.argsort(lengths, kind = "stable").tolist()
+    if prefix_cache:
+        # chunks of shared-prefix groups instead of sentence batches, see score_prefix_groups
+        batches = [([i for _, members in chunk for i in members], chunk) for chunk in group_chunks(prefix_groups(input_ids), token_budget)]
+    else:
+        batches = [(batch, None) for batch in token_batches(order, costs, token_budget)]
+    finished = {}
+    next_index = 0
+    for batch, batch_groups in batches:
+        batch_sentences = [sentences[i] for i in batch]
+        with instrument.forward("surprisal_forward", len(batch)):
+            if batch_groups is not None:
+                tokenwise_surprisals = score_prefix_groups(model, input_ids, batch_groups, token_budget)
+            else:
+                tokenwise_surprisals = model.token_score(batch_sentences, surprisal = True, base_two = True)
+                # each copy is padded to the longest sentence of the batch
+                instrument.count("surprisal_forward_tokens", sum(copies[i] for i in batch) * max(lengths[i] for i in batch))
+        with instrument.stage("align", len(batch)):
+            word_surprisals = align_batch_surprisal(tokenwise_surprisals, batch_sentences, model.tokenizer)
+        for i, scores, words in zip(batch, tokenwise_surprisals, word_surprisals):
+            finished[i] = target_surprisal(words, sentences[i], target_tokens[i], scores)
+        while next_index in finished:
+            yield finished.pop(next_index)
+            next_index += 1
+
+def token_batches(order : List[int], costs : List[int], token_budget : Optional[int], max_padding : Optional[float] = None) -> List[List[int]]:
+    # cut the ordered sentences into batches whose padded cost (batch size x largest cost) stays within the budget and,
+    # with max_padding, whose padding stays below that share of the padded cost
+    if token_budget is None and max_padding is None:
+        return [list(order)] if order else []
+    batches = [[]]
+    max_cost = total_cost = 0
+    for i in order:
+        padded_cost = (len(batches[-1]) + 1) * max(max_cost, costs[i])
+        if batches[-1] and ((token_budget is not None and padded_cost > token_budget) or
+                            (max_padding is not None and padded_cost - total_cost - costs[i] > max_padding * padded_cost)):
+            batches.append([])
+            max_cost = total_cost = 0
+        batches[-1].append(i)
+        max_cost = max(max_cost, costs[i])
+        total_cost += costs[i]
+    return batches if batches[0] else []
+
+def stream_masked_target_surprisal(model, sentences : List[str], target_tokens : List[str], token_budget : Optional[int] = 8192) -> Iterator[float]:
+    # Pseudo-log-likelihood of the target words only, in bits: one masked copy per target subtoken instead of one per
+    # sentence token. The masked copies of all sentences are packed into shared length-sorted batches.
+    # Gives the same values as summing MaskedLMScorer.token_score over the target words.
+    with instrument.stage("tokenize", len(sentences)):
+        encoded = model.tokenizer(sentences, return_offsets_mapping = True, return_special_tokens_mask = True)
+    input_ids = encoded['input_ids']
+    instrument.count("surprisal_tokens", sum(len(ids) for ids in input_ids))
+    variants = [] # (sentence, masked position)
+    for i, (sentence, target, offsets, special) in enumerate(zip(sentences, target_tokens, encoded['offset_mapping'], encoded['special_tokens_mask'])):
+        words, target_list = sentence.split(" "), target.split(" ")
+        token_words = token_word_ids(sentence, np.array(offsets).reshape(-1, 2))
+        variants.extend((i, position) for position, (word, is_special) in enumerate(zip(token_words, special))
+                        if not is_special and words[word] in target_list)
+    remaining = np.bincount([i for i, _ in variants], minlength = len(sentences))
+    surprisals = np.zeros(len(sentences))
+    costs = [len(input_ids[i]) for i, _ in variants]
+    device = model.model.device
+    pad_token_id = model.tokenizer.pad_token_id or 0
+    next_index = 0
+    for batch in token_batches(np.argsort(costs, kind = "stable").tolist(), costs, token_budget) if variants else []:
+        rows, positions = map(list, zip(*[variants[v] for v in batch]))
+        longest = max(costs[v] for v in batch)
+        masked_ids = torch.tensor([input_ids[i] + [pad_token_id] * (longest - len(input_ids[i])) for i in rows], device = device)
+        attention_mask = (torch.arange(longest, device = device) < torch.tensor([len(input_ids[i]) for i in rows], device = device)[:, None]).long()
+        batch_index, positions = torch.arange(len(batch), device = device), torch.tensor(positions, device = device)
+        target_ids = masked_ids[batch_index, positions]
+        masked_ids[batch_index, positions] = model.mask_token_id
+        instrument.count("masked_variants", len(batch))
+        instrument.count("surprisal_forward_tokens", masked_ids.numel())
+        with torch.no_grad(), instrument.forward("surprisal_forward", len(batch)):
+            logits = model.model(masked_ids, attention_mask = attention_mask).logits[batch_index, positions]
+        token_surprisals = -torch.log_softmax(logits.float(), dim = -1).gather(1, target_ids[:, None])[:, 0] / np.log(2)
+        np.add.at(surprisals, rows, token_surprisals.double().cpu().numpy())
+        np.subtract.at(remaining, rows, 1)
+        while next_index < len(sentences) and remaining[next_index] == 0:
+            yield float(surprisals[next_index])
+            next_index += 1
+    # sentences without a target subtoken score 0, as when summing over no matching words
+    while next_index < len(sentences):
+        yield float(surprisals[next_index])
+        next_index += 1
+
+def prefix_groups(input_ids : List[List[int]], min_prefix : int = 2):
+    # groups sentences (sorted by token ids) that share at least min_prefix leading tokens; returns (prefix length, members).
+    # A sentence joins the current group only if that lowers the total number of tokens run through the model,
+    # i.e. if members x new prefix > (members - 1) x current prefix.
+    order = sorted(range(len(input_ids)), key = lambda i: input_ids[i])
+    groups = []
+    for i in order:
+        if groups:
+            prefix_length, members = groups[-1]
+            shared = 0
+            first = input_ids[members[0]]
+            while shared < min(prefix_length, len(input_ids[i])) and first[shared] == input_ids[i][shared]:
+                shared += 1
+            if shared >= min_prefix and len(members) * shared > (len(members) - 1) * prefix_length:
+                groups[-1] = (shared, members + [i])
+                continue
+        groups.append((len(input_ids[i]), [i]))
+    # every member keeps at least one token to score after the prefix
+    return [(max(min(prefix_length, min(len(input_ids[i]) for i in members) - 1), 0), members) for prefix_length, members in groups]
+
+def padded(rows : List[List[int]], pad_token_id : int, device):
+    # right-padded ids and their attention mask
+    longest = max(len(row) for row in rows)
+    ids = torch.tensor([row + [pad_token_id] * (longest - len(row)) for row in rows], device = device)
+    mask = (torch.arange(longest, device = device) < torch.tensor([len(row) for row in rows], device = device)[:, None]).long()
+    return ids, mask
+
+def legacy_cache(past_key_values):
+    # ((key, value), ...) per layer, each (batch, heads, tokens, head size), from a tuple cache or a Cache object
+    return past_key_values.to_legacy_cache() if hasattr(past_key_values, "to_legacy_cache") else past_key_values
+
+# share of a prefix-cache forward pass that may be padding before a new pass is started
+PREFIX_BATCH_PADDING = 0.2
+
+def group_chunks(groups : List, token_budget : Optional[int]) -> List[List]:
+    # consecutive prefix groups with at most token_budget prefix tokens in all, so the prefixes a chunk keeps cached
+    # take no more memory than the key/value cache of one plain batch
+    chunks = [[]]
+    n_cached = 0
+    for prefix_length, members in groups:
+        if chunks[-1] and token_budget is not None and n_cached + prefix_length > token_budget:
+            chunks.append([])
+            n_cached = 0
+        chunks[-1].append((prefix_length, members))
+        n_cached += prefix_length
+    return chunks if chunks[0] else []
+
+def score_prefix_groups(model, input_ids : List[List[int]], groups : List, token_budget : Optional[int] = None, base_two : bool = True):
+    """
+    Token surprisals of the members of prefix groups (see prefix_groups), in member order. Each group's shared prefix
+    runs once: prefix passes batch the prefixes sorted by length and keep their keys and values; continuation passes
+    batch the rest of every sentence sorted by length, each attending to its group's cached prefix. The last token of
+    a sentence predicts nothing and is never run, so a group of one sentence needs no continuation pass.
+    """
+    log_base = np.log(2) if base_two else 1.0
+    device = model.model.device
+    pad_token_id = model.tokenizer.pad_token_id or 0
+    prefix_lengths = [prefix_length for prefix_length, _ in groups]
+    rows = [(group, i) for group, (_, members) in enumerate(groups) for i in members]
+    # logprobs[row][k] is the log-probability of token k + 1 of the row's sentence
+    logprobs = [torch.empty(len(input_ids[i]) - 1, device = device) for _, i in rows]
+    group_rows = [[] for _ in groups]
+    for row, (group, _) in enumerate(rows):
+        group_rows[group].append(row)
+
+    # prefix passes; the cached keys and values of all prefixes are stored back to back, one (heads, tokens, head size) pair per layer
+    prefixed = [group for group in range(len(groups)) if prefix_lengths[group]]
+    offsets = torch.zeros(len(groups), dtype = torch.long, device = device)
+    keys, values = [], []
+    n_cached = 0
+    for batch in token_batches(sorted(prefixed, key = lambda group: prefix_lengths[group]), prefix_lengths, token_budget, PREFIX_BATCH_PADDING):
+        prefix_ids, prefix_mask = padded([input_ids[groups[group][1][0]][:prefix_lengths[group]] for group in batch], pad_token_id, device)
+        instrument.count("surprisal_forward_tokens", prefix_ids.numel())
+        with torch.no_grad():
+            output = model.model(prefix_ids, attention_mask = prefix_mask, use_cache = True)
+        prefix_logprobs = torch.log_softmax(output.logits.float(), dim = -1)
+        for b, group in enumerate(batch):
+            prefix_length = prefix_lengths[group]
+            for row in group_rows[group]:
+                # the prefix predicts its own tokens and the first token after it, which differs between members
+                targets = torch.tensor(input_ids[rows[row][1]][1:prefix_length + 1], device = device)
+                logprobs[row][:prefix_length] = prefix_logprobs[b, :prefix_length].gather(1, targets[:, None])[:, 0]
+        offsets[batch] = n_cached + torch.cumsum(prefix_mask.sum(1), 0) - prefix_mask.sum(1)
+        n_cached += int(prefix_mask.sum())
+        cached = [[tensor.transpose(0, 1)[:, prefix_mask.bool()] for tensor in layer] for layer in legacy_cache(output.past_key_values)]
+        keys.append([layer[0] for layer in cached])
+        values.append([layer[1] for layer in cached])
+    keys = [torch.cat(layer, dim = 1) for layer in zip(*keys)]
+    values = [torch.cat(layer, dim = 1) for layer in zip(*values)]
+
+    # continuation passes over the tokens after each prefix, except the last
+    continuations = [input_ids[i][prefix_lengths[group]:-1] for group, i in rows]
+    continuing = sorted((row for row in range(len(rows)) if continuations[row]), key = lambda row: len(continuations[row]))
+    costs = [len(continuation) for continuation in continuations]
+    for batch in token_batches(continuing, costs, token_budget, PREFIX_BATCH_PADDING):
+        row_groups = torch.tensor([rows[row][0] for row in batch], device = device)
+        row_prefix_lengths = torch.tensor([prefix_lengths[rows[row][0]] for row in batch], device = device)
+        continuation_ids, continuation_mask = padded([continuations[row] for row in batch], pad_token_id, device)
+        instrument.count("surprisal_forward_tokens", continuation_ids.numel())
+        # gather each row's cached prefix, right-padded to the longest prefix in the batch
+        positions = torch.arange(int(row_prefix_lengths.max()), device = device)
+        cache_mask = positions < row_prefix_lengths[:, None]
+        cache_index = torch.where(cache_mask, offsets[row_groups, None] + positions, 0)
+        past_key_values = tuple((key[:, cache_index].transpose(0, 1), value[:, cache_index].transpose(0, 1)) for key, value in zip(keys, values))
+        with torch.no_grad():
+            output = model.model(continuation_ids, past_key_values = past_key_values, use_cache = False,
+                                 attention_mask = torch.cat([cache_mask.long(), continuation_mask], dim = 1),
+                                 position_ids = row_prefix_lengths[:, None] + torch.arange(continuation_ids.shape[1], device = device))
+        continuation_logprobs = torch.log_softmax(output.logits.float(), dim = -1)
+        for b, row in enumerate(batch):
+            group, i = rows[row]
+            prefix_length, length = prefix_lengths[group], len(continuations[row])
+            targets = torch.tensor(input_ids[i][prefix_length + 1:], device = device)
+            logprobs[row][prefix_length:] = continuation_logprobs[b, :length].gather(1, targets[:, None])[:, 0]
+    return [list(zip(model.decode(input_ids[i]), [0.0] + (-logprobs[row].double() / log_base).tolist())) for row, (_, i) in enumerate(rows)]
+
+def prefix_cached_token_score(model, sentences : List[str], base_two : bool = True, min_prefix : int = 2, token_budget : Optional[int] = None):
+    # Same output as model.token_score(sentences, surprisal = True, base_two = base_two) for an IncrementalLMScorer,
+    # but the key/value cache of each shared token prefix is computed once and only the continuations are run per sentence.
+    input_ids = model.tokenizer(sentences)['input_ids']
+    groups = prefix_groups(input_ids, min_prefix)
+    surprisals = [None] * len(sentences)
+    for chunk in group_chunks(groups, token_budget):
+        members = [i for _, chunk_members in chunk for i in chunk_members]
+        for i, scores in zip(members, score_prefix_groups(model, input_ids, chunk, token_budget, base_two)):
+            surprisals[i] = scores
+    return surprisals
+
+def target_surprisal(word_surprisals : Optional[List[Tuple[str, float]]], sentence : str, target_tokens : str, scores = None):
+    if word_surprisals is None:
+        print(f"Failed to compute surprisal for sentence {sentence} with scores {scores}")
+        instrument.count("alignment_failures")
+        return -1
+    target_list = target_tokens.split(" ")
+    return sum(surprisal for word, surprisal in word_surprisals if word in target_list)
 
 def word_final_surprisal(model, sentence, bi = True):
     surprisals = model.token_score(sentence, surprisal = True, base_two = True)[0]
-    token_surprisals = align_surprisal(surprisals, sentence)
+    token_surprisals = align_surprisal(surprisals, sentence, model.tokenizer)
     if not bi:
         return np.sum([result[1] for result in token_surprisals[-2:]])
     return token_surprisals[-2][1] # getting probability of the word alone
 
-def align_surprisal(token_surprisals: List[Tuple[str, float]], sentence: str):
-    words = sentence.split(" ")
-    token_index = 0
-    word_index = 0
-    word_level_surprisal = []  # list of word, surprisal tuples
-    while token_index < len(token_surprisals):
-        current_word = words[word_index]
-        current_token, current_surprisal = token_surprisals[token_index]
-        # token does not match, alignment must be adjusted
-        mismatch = (current_token != current_word)
-
-        while mismatch:
-            token_index += 1
-            current_token += token_surprisals[token_index][0].strip("##")
-            current_surprisal += token_surprisals[token_index][1]
-            mismatch = current_token != current_word
-        word_level_surprisal.append((current_word, current_surprisal))
-        token_index += 1
-        word_index += 1
-    return word_level_surprisal
-
-def surprisal_effects(data : pd.DataFrame, surprisal_cols : List[str], comparison_cols: List[str], condition_name : str):
-    # get the reversal and comparison columns from the stimulus config
-    item_ids = data[data['condition'].isin(comparison_cols)]['item'].unique()
-    diffs = []
-    for item in item_ids:
-        item_sentences = data[data['item'] == item]
-        implausible_comparison = get_sentence_data(item_sentences, comparison_cols[0])
-        plausible_comparison = get_sentence_data(item_sentences, comparison_cols[1])
-        row = {
-            "item": int(item)
-        }
-        for column_name in surprisal_cols: # should be in format {model}_surprisal
-            row[f"{column_name}_surprisal_effect"] = implausible_comparison[column_name].values[0] - plausible_comparison[column_name].values[0]
-        diffs.append(row)
-    expt_effects = pd.DataFrame(diffs)
-    expt_effects['condition'] = condition_name # experiments had both reversal and comparison conditions.
-    return expt_effects
-
-def get_sentence_data(item_data : pd.DataFrame, sentence_type : str):
-    return item_data[item_data['condition'] == sentence_type]
-
-def reversal_surprisal_effect(data: pd.DataFrame, surprisal_cols: List[str]):
-    # for Ettinger reversal items
-    item_ids = data['item'].str.split("-").apply(lambda lst: lst[0]).unique()
-    diffs = []
-    for item in item_ids:
-        item_sentences = data[data['item'].str.contains(item)]
-        canonical = item_sentences[item_sentences['item'] == item + "-a"]
-        reverse = item_sentences[item_sentences['item'] == item + "-b"]
-        row = {
-            "item": int(item),
-            "verb":canonical['target'].values[0],
-            "canonical_context" : canonical['context'].values[0],
-            "reversed_context": reverse['context'].values[0],
-            "canonical_cloze": canonical['tgt_cloze'].values[0],
-            "reversed_cloze": reverse['tgt_cloze'].values[0],
-        }
-        for column_name in surprisal_cols: # should be in format {model}_surprisal
-            row[f"canonical_{column_name}"] = canonical[column_name].values[0],
-            row[f"reversed_{column_name}"] = reverse[column_name].values[0],
-            row[f"{column_name}_effect"] = reverse[column_name].values[0] - canonical[column_name].values[0]
-        diffs.append(row)
-    reversal_effects = pd.DataFrame(diffs)
-    return reversal_effects
+def align_surprisal(token_surprisals: List[Tuple[str, float]], sentence: str, tokenizer):
+    return align_batch_surprisal([token_surprisals], [sentence], tokenizer)[0]
+
+def token_word_ids(sentence : str, offsets : np.ndarray) -> np.ndarray:
+    # index of the space-separated word holding each token's last character (fast-tokenizer offsets);
+    # whitespace-only tokens (e.g. a lone "Ġ") start the next word
+    word_starts = np.cumsum([0] + [len(word) + 1 for word in sentence.split(" ")[:-1]])
+    last_chars = np.maximum(offsets[:, 1] - 1, 0)
+    is_space = np.array([char == " " for char in sentence] + [False])
+    last_chars = np.where(is_space[last_chars], last_chars + 1, last_chars)
+    return np.searchsorted(word_starts, last_chars, side = "right") - 1
+
+def align_batch_surprisal(batch_token_surprisals : List[List[Tuple[str, float]]], sentences : List[str], tokenizer):
+    # Maps every scored token to the space-separated word containing its last character (fast-tokenizer offsets),
+    # then sums surprisals per word with one segment sum over the whole batch. Returns a list of (word, surprisal)
+    # tuples per sentence, or None where the scores do not line up with the tokenization.
+    encoded = tokenizer(sentences, return_offsets_mapping = True, return_special_tokens_mask = True)
+    batch_words, word_ids, surprisals = [], [], []
+    word_offset = 0
+    for token_surprisals, sentence, offsets, special in zip(batch_token_surprisals, sentences, encoded['offset_mapping'], encoded['special_tokens_mask']):
+        words = sentence.split(" ")
+        offsets, special = np.array(offsets).reshape(-1, 2), np.array(special, dtype = bool)
+        if len(token_surprisals) != len(offsets):
+            # masked LM scorers leave out the special tokens
+            offsets, special = offsets[~special], special[~special]
+        if len(token_surprisals) != len(offsets):
+            batch_words.append(None)
+            continue
+        token_words = token_word_ids(sentence, offsets)
+        scores = np.array([score for _, score in token_surprisals], dtype = float)
+        batch_words.append((words, word_offset, token_words[~special].max(initial = -1) + 1))
+        word_ids.append(token_words[~special] + word_offset)
+        surprisals.append(scores[~special])
+        word_offset += len(words)
+
+    word_level_surprisal = np.zeros(word_offset)
+    if word_ids:
+        word_ids, surprisals = np.concatenate(word_ids), np.concatenate(surprisals)
+        if len(word_ids):
+            segment_starts = np.flatnonzero(np.r_[True, word_ids[1:] != word_ids[:-1]])
+            word_level_surprisal[word_ids[segment_starts]] = np.add.reduceat(surprisals, segment_starts)
+
+    aligned = []
+    for entry in batch_words:
+        if entry is None:
+            aligned.append(None)
+            continue
+        words, offset, n_scored = entry
+        # words after the last scored token (e.g. a trailing space) are left out
+        aligned.append(list(zip(words[:n_scored], word_level_surprisal[offset:offset + n_scored].tolist())))
+    return aligned
 
 def cloze_surprisal(row, model, cloze_col, is_bi):
     sentence = row['context'].replace("[MASK]", row[cloze_col])
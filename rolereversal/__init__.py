@@ -0,0 +1 @@
+"""Argument role analyses of language models; run python -m rolereversal --help for the commands."""
@@ -0,0 +1,5 @@
+import sys
+
+from rolereversal.cli import main
+
+sys.exit(main())
@@ -0,0 +1,190 @@
+"""
+Command line interface: python -m rolereversal <command> [options].
+
+torch, transformers, minicons and the plotting libraries are imported inside the command that uses them,
+so --help, validate, effects and plot start without paying for them.
+"""
+
+import argparse
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DATA_DIR = os.path.join(REPO_DIR, "data")
+RESULTS_DIR = os.path.join(REPO_DIR, "results")
+CONFIG_PATH = os.path.join(DATA_DIR, "stimulus_config.json")
+SURPRISAL_DIR = os.path.join(DATA_DIR, "surprisal_results")
+FIGURES_DIR = os.path.join(REPO_DIR, "figures")
+
+# functions/ lives next to this package in the repo root, which is not on sys.path when running from another directory
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+# standard library only, like this module
+from functions.options import (ATTENTION_MODELS, PROBE_EXPERIMENTS, PROBE_LAYERS, PROBED_EXPERIMENTS, SCORING_MODELS, add_model_options,
+                               add_precision_option, add_scoring_options, add_serve_options)
+
+def main(argv = None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    # the scripts write their trace and attach the profiler based on these, read when functions.instrument is imported
+    if args.trace:
+        os.environ["ROLEREVERSAL_TRACE"] = os.path.abspath(args.trace)
+    if args.profile:
+        os.environ["ROLEREVERSAL_PROFILE"] = "1"
+    return args.handler(args) or 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='rolereversal', description='Argument role analyses of language models: surprisal, probing and attention')
+    parser.add_argument('--trace', default=None, help='Write a JSON trace of per-stage timings and peak memory to this path')
+    parser.add_argument('--profile', action='store_true', help='Run forward passes under torch.profiler (slow)')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    validate = commands.add_parser('validate', help='Check the stimulus config and stimulus files without loading any model')
+    validate.add_argument('--config', default=CONFIG_PATH, help='Path to the stimulus config')
+    validate.add_argument('--data-dir', default=DATA_DIR, help='Directory with the stimulus CSVs named in the config')
+    validate.add_argument('--paired-data', default=os.path.join(DATA_DIR, 'df_comb.csv'), help='Combined stimuli used for probing and attention')
+    validate.set_defaults(handler=run_validate)
+
+    score = commands.add_parser('score', help='Score every model on every dataset in the stimulus config')
+    score.add_argument('--models', nargs='+', default=SCORING_MODELS, help='model names, should be in minicons')
+    score.add_argument('--config', default=CONFIG_PATH, help='Path to the stimulus config')
+    score.add_argument('--data-dir', default=DATA_DIR, help='Directory with the stimulus CSVs named in the config')
+    score.add_argument('--output-dir', default=SURPRISAL_DIR, help='Directory for the scored datasets')
+    score.add_argument('--format', choices=['parquet', 'feather'], default='parquet', help='Columnar output format')
+    score.add_argument('--workers', type=int, default=1, help='Models scored in parallel, each in its own process with an equal share of the cores')
+    add_scoring_options(score)
+    add_model_options(score)
+    score.set_defaults(handler=run_score)
+
+    probe = commands.add_parser('probe', help='Probe verb embeddings layer by layer for plausibility')
+    probe.add_argument('--models', nargs='+', default=list(PROBE_LAYERS),
+                       help=f'model names, or name:layers for models other than {", ".join(PROBE_LAYERS)}')
+    probe.add_argument('--experiments', nargs='+', choices=PROBE_EXPERIMENTS, default=PROBED_EXPERIMENTS)
+    probe.add_argument('--data', default=os.path.join(DATA_DIR, 'df_comb.csv'), help='Combined stimuli')
+    probe.add_argument('--results-dir', default=RESULTS_DIR, help='Directory for the per-experiment JSON results')
+    probe.add_argument('--store-dir', default=os.path.join(RESULTS_DIR, 'representations'), help='Cache of extracted hidden states')
+    probe.add_argument('--workers', type=int, default=None, help='Models probed in parallel (default: as many as there are models and cores)')
+    probe.add_argument('--seed', type=int, default=0)
+    probe.add_argument('--permutations', type=int, default=1000, help='Shuffled-label fits per layer for the permutation baseline')
+    add_model_options(probe, export_dir=False)
+    probe.set_defaults(handler=run_probe)
+
+    attention = commands.add_parser('attention', help='Find the heads attending most from the verb to the agent and the patient')
+    attention.add_argument('--models', nargs='+', default=ATTENTION_MODELS)
+    attention.add_argument('--data', default=os.path.join(DATA_DIR, 'df_comb.csv'), help='Combined stimuli')
+    attention.add_argument('--output-dir', default=RESULTS_DIR, help='Directory for the attn_{model}.csv results')
+    attention.add_argument('--capture', choices=['hooks', 'outputs'], default='hooks', help='Capture attention with forward hooks or output_attentions')
+    attention.add_argument('--batch-size', type=int, default=32)
+    add_precision_option(attention)
+    attention.set_defaults(handler=run_attention)
+
+    effects = commands.add_parser('effects', help='Compute item-level surprisal effects with bootstrap CIs and permutation p-values')
+    effects.add_argument('--surprisal-dir', default=SURPRISAL_DIR, help='Directory with the scored datasets')
+    effects.add_argument('--config', default=CONFIG_PATH, help='Path to the stimulus config')
+    effects.add_argument('--resamples', type=int, default=10000, help='Bootstrap and permutation resamples per effect')
+    effects.add_argument('--seed', type=int, default=0)
+    effects.set_defaults(handler=run_effects)
+
+    serve = commands.add_parser('serve', help='Keep models loaded and serve surprisals and sentence embeddings over local HTTP')
+    add_serve_options(serve)
+    serve.set_defaults(handler=run_serve)
+
+    plot = commands.add_parser('plot', help='Plot surprisal effects or probing accuracy')
+    plot.add_argument('what', choices=['surprisal', 'probe'])
+    plot.add_argument('--surprisal-dir', default=SURPRISAL_DIR, help='Directory with surprisal_effects.csv')
+    plot.add_argument('--results-dir', default=RESULTS_DIR, help='Directory with the probing results')
+    plot.add_argument('--models', nargs='+', default=None, help='Models to plot probing accuracy for')
+    plot.add_argument('--figures-dir', default=FIGURES_DIR)
+    plot.set_defaults(handler=run_plot)
+    return parser
+
+def use_scripts():
+    # the pipelines live in run_functions/ and import functions/ from the repo root
+    for path in [REPO_DIR, os.path.join(REPO_DIR, "run_functions")]:
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+def report(errors):
+    for error in errors:
+        print(f"error: {error}", file=sys.stderr)
+    return 1 if errors else 0
+
+def probe_layers(models):
+    model_layers = {}
+    for model in models:
+        model_name, _, layers = model.partition(":")
+        if layers:
+            model_layers[model_name] = int(layers)
+        elif model_name in PROBE_LAYERS:
+            model_layers[model_name] = PROBE_LAYERS[model_name]
+        else:
+            raise SystemExit(f"error: number of layers unknown for {model_name}, pass it as {model_name}:<layers>")
+    return model_layers
+
+def run_validate(args):
+    from rolereversal.config import validate_paired_stimuli, validate_stimulus_config
+    errors = validate_stimulus_config(args.config, args.data_dir) + validate_paired_stimuli(args.paired_data)
+    if not errors:
+        print(f"{args.config} and {args.paired_data} are valid")
+    return report(errors)
+
+def run_score(args):
+    from rolereversal.config import validate_stimulus_config
+    errors = validate_stimulus_config(args.config, args.data_dir)
+    if errors:
+        return report(errors)
+    use_scripts()
+    import compute_all_surprisals
+    compute_all_surprisals.score_config(args.config, args.data_dir, args.models, args.output_dir, args.format, args.token_budget, args.prefix_cache,
+                                        args.target_only, args.workers, args.precision, args.backend, args.export_dir)
+    from functions import instrument
+    instrument.write_trace()
+
+def run_probe(args):
+    from rolereversal.config import validate_paired_stimuli
+    model_layers = probe_layers(args.models)
+    errors = validate_paired_stimuli(args.data)
+    if errors:
+        return report(errors)
+    os.makedirs(args.results_dir, exist_ok=True)
+    use_scripts()
+    import run_probe
+    run_probe.main(args.data, args.results_dir, args.store_dir, model_layers, args.experiments, args.precision, args.backend, args.workers,
+                   args.seed, args.permutations)
+
+def run_attention(args):
+    from rolereversal.config import validate_paired_stimuli
+    errors = validate_paired_stimuli(args.data)
+    if errors:
+        return report(errors)
+    os.makedirs(args.output_dir, exist_ok=True)
+    use_scripts()
+    import run_attention
+    run_attention.main(args.data, args.output_dir, args.models, args.precision, args.capture, args.batch_size)
+
+def run_effects(args):
+    from rolereversal.config import validate_stimulus_config
+    errors = validate_stimulus_config(args.config)
+    if errors:
+        return report(errors)
+    use_scripts()
+    import run_surprisal
+    run_surprisal.write_effects(args.surprisal_dir, args.config, args.resamples, args.seed)
+
+def run_serve(args):
+    use_scripts()
+    import scoring_server
+    scoring_server.serve(args.models, args.embed_models, args.host, args.port, args.window_ms / 1000, args.max_batch, args.token_budget,
+                         args.prefix_cache, args.target_only, args.precision, args.backend, args.offline, args.export_dir)
+
+def run_plot(args):
+    use_scripts()
+    if args.what == 'surprisal':
+        import run_surprisal
+        run_surprisal.plot_effects(os.path.join(args.surprisal_dir, "surprisal_effects.csv"), args.figures_dir)
+    else:
+        import plot_probe
+        plot_probe.plot_probe_accuracy(args.results_dir, args.figures_dir, args.models)
@@ -0,0 +1,27 @@
+import json
+import urllib.error
+import urllib.request
+from typing import List, Optional
+
+# client for run_functions/scoring_server.py (python -m rolereversal serve); standard library only
+SERVER_URL = "http://127.0.0.1:8765"
+
+def post(path : str, payload : dict, url : str = SERVER_URL, timeout : float = 300):
+    request = urllib.request.Request(url + path, data=json.dumps(payload).encode(), headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as error:
+        raise RuntimeError(f"{path} failed with {error.code}: {json.load(error).get('error')}") from None
+
+def score(model : str, sentences : List[str], targets : List[str], url : str = SERVER_URL) -> List[float]:
+    # summed surprisal (bits) of the target words in each sentence, as surprisal_at_word computes it
+    return post("/score", {"model": model, "sentences": sentences, "targets": targets}, url)["surprisals"]
+
+def embed(model : str, sentences : List[str], layers : List[int], pooling : Optional[str] = None, url : str = SERVER_URL) -> List[List[List[float]]]:
+    # (sentences, layers, hidden) pooled sentence embeddings, layers in sorted order
+    return post("/embed", {"model": model, "sentences": sentences, "layers": layers, "pooling": pooling}, url)["embeddings"]
+
+def health(url : str = SERVER_URL) -> dict:
+    with urllib.request.urlopen(url + "/health") as response:
+        return json.load(response)
@@ -0,0 +1,67 @@
+import csv
+import json
+import os
+from typing import List
+
+# standard library only, so validating a run costs no heavy imports
+SCORING_COLUMNS = ["item", "sentence", "condition", "target"]
+PAIRED_COLUMNS = ["exp", "item", "type", "sentence", "target", "plausibility"]
+
+def read_columns(path : str, value_column : str = None):
+    # header of a CSV, and the distinct values of one of its columns
+    with open(path, newline="") as file:
+        reader = csv.DictReader(file)
+        values = {row[value_column] for row in reader} if value_column in (reader.fieldnames or []) else set()
+        return reader.fieldnames or [], values
+
+def missing_columns(path : str, columns : List[str], present : List[str]) -> List[str]:
+    missing = [column for column in columns if column not in present]
+    return [f"{path}: missing columns {missing}"] if missing else []
+
+def validate_stimulus_config(config_path : str, data_dir : str = None) -> List[str]:
+    """
+    Problems with a stimulus config: each entry needs a two-condition "comparison", a "comparison_condition" and a "name",
+    and may have a two-condition "reversal". With data_dir, each named CSV must exist there, have the scoring columns
+    and contain the conditions the entry compares. Returns a list of messages, empty when the config is usable.
+    """
+    if not os.path.exists(config_path):
+        return [f"{config_path}: no such file"]
+    try:
+        with open(config_path, "r") as file:
+            stimulus_config = json.load(file)
+    except json.JSONDecodeError as error:
+        return [f"{config_path}: not valid JSON ({error})"]
+    if not isinstance(stimulus_config, dict) or not stimulus_config:
+        return [f"{config_path}: expected an object mapping stimulus files to their conditions"]
+
+    errors = []
+    for filename, config in stimulus_config.items():
+        if not isinstance(config, dict):
+            errors.append(f"{filename}: expected an object, got {type(config).__name__}")
+            continue
+        for key in ["comparison", "comparison_condition", "name"]:
+            if key not in config:
+                errors.append(f"{filename}: missing '{key}'")
+        for key in ["reversal", "comparison"]:
+            if key in config and not (isinstance(config[key], list) and len(config[key]) == 2):
+                errors.append(f"{filename}: '{key}' should list the implausible and the plausible condition")
+        if data_dir is None:
+            continue
+        path = os.path.join(data_dir, filename)
+        if not os.path.exists(path):
+            errors.append(f"{path}: no such file")
+            continue
+        columns, conditions = read_columns(path, "condition")
+        errors.extend(missing_columns(path, SCORING_COLUMNS, columns))
+        for key in ["reversal", "comparison"]:
+            unknown = [condition for condition in config.get(key) or [] if conditions and condition not in conditions]
+            if unknown:
+                errors.append(f"{path}: '{key}' conditions {unknown} do not occur in the condition column")
+    return errors
+
+def validate_paired_stimuli(path : str) -> List[str]:
+    # the combined stimuli used for probing and attention
+    if not os.path.exists(path):
+        return [f"{path}: no such file"]
+    columns, _ = read_columns(path)
+    return missing_columns(path, PAIRED_COLUMNS, columns)
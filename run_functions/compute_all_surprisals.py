@@ -0,0 +1,98 @@
+import argparse
+import functools
+import json
+import os
+
+import pandas as pd
+
+import sys
+sys.path.append("..")
+from functions import instrument, options, scheduler
+from functions.options import EXPORT_DIR, SCORING_MODELS
+from functions.surprisal import surprisal_at_word
+from surprisal_for_model import load_model
+
+def main():
+    parser = argparse.ArgumentParser(description='Score every model on every dataset in the stimulus config, loading each model once')
+    parser.add_argument('--models', nargs='+', default=SCORING_MODELS, help='model names, should be in minicons')
+    parser.add_argument('--config', default='../data/stimulus_config.json', help='Path to the stimulus config')
+    parser.add_argument('--data-dir', default='../data', help='Directory with the stimulus CSVs named in the config')
+    parser.add_argument('--output-dir', default='../data/surprisal_results', help='Directory for the scored datasets')
+    parser.add_argument('--format', choices=['parquet', 'feather'], default='parquet', help='Columnar output format')
+    parser.add_argument('--workers', type=int, default=1, help='Models scored in parallel, each in its own process with an equal share of the cores')
+    options.add_scoring_options(parser)
+    options.add_model_options(parser)
+    options.add_trace_options(parser)
+
+    args = parser.parse_args()
+    if args.profile:
+        instrument.enable_profiler()
+    score_config(args.config, args.data_dir, args.models, args.output_dir, args.format, args.token_budget, args.prefix_cache, args.target_only,
+                 args.workers, args.precision, args.backend, args.export_dir)
+    instrument.write_trace(args.trace)
+
+def score_config(config_path : str, data_dir : str, model_names, output_dir : str, file_format : str = 'parquet', token_budget : int = 8192,
+                 prefix_cache : bool = False, target_only : bool = False, n_workers : int = 1, precision : str = "fp32", backend : str = "eager",
+                 export_dir : str = EXPORT_DIR):
+    with open(config_path, "r") as file:
+        stimulus_config = json.load(file)
+    with instrument.stage("csv_read", len(stimulus_config)):
+        datasets = {filename: pd.read_csv(os.path.join(data_dir, filename)) for filename in stimulus_config}
+    os.makedirs(output_dir, exist_ok=True)
+    run_sweep(datasets, model_names, output_dir, file_format, token_budget, prefix_cache, target_only, n_workers, precision, backend, export_dir)
+
+def result_path(output_dir : str, filename : str, file_format : str):
+    return os.path.join(output_dir, f"{os.path.splitext(filename)[0]}.{file_format}")
+
+@instrument.timed("results_read")
+def read_results(path : str, file_format : str):
+    return pd.read_parquet(path) if file_format == 'parquet' else pd.read_feather(path)
+
+@instrument.timed("results_write")
+def write_results(data : pd.DataFrame, path : str, file_format : str):
+    # write next to the destination and rename, so readers never see a half-written file
+    tmp_path = path + ".tmp"
+    if file_format == 'parquet':
+        data.to_parquet(tmp_path, index = False)
+    else:
+        data.to_feather(tmp_path)
+    os.replace(tmp_path, path)
+
+def score_dataset(model, model_name : str, data : pd.DataFrame, token_budget : int, prefix_cache : bool = False, target_only : bool = False):
+    sentences = data['sentence']
+    if 'uncased' in model_name:
+        sentences = sentences.str.lower()
+    return surprisal_at_word(model, sentences.tolist(), data['target'].tolist(), token_budget, prefix_cache, target_only)
+
+def score_job(model, model_name : str, job):
+    # one scheduler job: a dataset and the scoring settings, scored with an already loaded model
+    filename, data, token_budget, prefix_cache, target_only = job
+    print(f"Processing experiment: {filename} with {model_name}")
+    return score_dataset(model, model_name, data, token_budget, prefix_cache, target_only)
+
+def load_sweep_model(model_name : str, precision : str = "fp32", backend : str = "eager", export_dir : str = EXPORT_DIR):
+    print(f"Generating Surprisals for model: {model_name}")
+    return load_model(model_name, precision, backend, export_dir)
+
+def run_sweep(datasets, model_names, output_dir : str, file_format : str, token_budget : int, prefix_cache : bool = False, target_only : bool = False,
+              n_workers : int = 1, precision : str = "fp32", backend : str = "eager", export_dir : str = EXPORT_DIR):
+    results = {}
+    for filename, data in datasets.items():
+        path = result_path(output_dir, filename, file_format)
+        # keep columns scored by earlier runs for models that are not part of this sweep
+        previous = read_results(path, file_format) if os.path.exists(path) else None
+        results[filename] = previous if previous is not None and len(previous) == len(data) else data.reset_index(drop = True)
+
+    # workers score, this process is the only writer and saves each dataset as soon as a model finishes it
+    def save_result(model_name, job, surprisals):
+        filename = job[0]
+        results[filename][f'{model_name}_surprisal'] = surprisals
+        path = result_path(output_dir, filename, file_format)
+        write_results(results[filename], path, file_format)
+        print(f"Successfully processed {model_name}. Output saved to {path}")
+
+    jobs = scheduler.expand_jobs(model_names, [(filename, data, token_budget, prefix_cache, target_only) for filename, data in datasets.items()])
+    scheduler.run_jobs(jobs, functools.partial(load_sweep_model, precision = precision, backend = backend, export_dir = export_dir), score_job, save_result, n_workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+
+import pandas as pd
+
+import sys
+sys.path.append("..")
+from functions.checkpoint import path_name
+
+MODELS = [
+    ('gpt2', 'GPT2-small'),
+    ('gpt2-medium', 'GPT2-medium'),
+    ('bert-large-uncased', 'BERT-large'),
+    ('roberta-large', 'RoBERTa-large')
+]
+# experiment, label and line color of each panel's curves
+CONDITIONS = [
+    ("WY_rev", 'swap-arguments', 'blue'),
+    ("KO_rev", 'change-verb', 'green'),
+    ("WY_sub", 'replace-argument', 'orange'),
+]
+
+def main():
+    parser = argparse.ArgumentParser(description='Plot probing accuracy per layer from the results written by run_probe.py')
+    parser.add_argument('--results-dir', default='../results', help='Directory with the probe_{experiment}_{model}.json results')
+    parser.add_argument('--figures-dir', default='figures', help='Directory for the plot')
+    parser.add_argument('--models', nargs='+', default=[model_name for model_name, _ in MODELS])
+
+    args = parser.parse_args()
+    plot_probe_accuracy(args.results_dir, args.figures_dir, args.models)
+
+def load_results(results_dir : str, model_names, experiment_names):
+    results = {}
+    for model_name in model_names:
+        for experiment_name in experiment_names:
+            file_path = os.path.join(results_dir, f'probe_{experiment_name}_{path_name(model_name)}.json')
+            with open(file_path, 'r') as file:
+                layer_results = json.load(file)
+            # results written before they recorded their settings hold the layers directly
+            results[f"{experiment_name}_{model_name}"] = layer_results.get("layers", layer_results)
+    return results
+
+def layer_accuracies(layer_results : dict) -> pd.DataFrame:
+    probe_data = pd.DataFrame(layer_results).melt()
+    probe_data.columns = ['Layer', 'Accuracy']
+    probe_data['Layer'] = probe_data['Layer'].astype(int)
+    return probe_data
+
+def plot_CSLP(ax, probe_data, title):
+    lines = []
+    for data, (_, label, color) in zip(probe_data, CONDITIONS):
+        mean = data.groupby('Layer')['Accuracy'].mean()
+        sem = data.groupby('Layer')['Accuracy'].sem()
+        line, = ax.plot(mean.index, mean, label=label, color=color)
+        ax.fill_between(mean.index, mean - sem, mean + sem, color=color, alpha=0.3)
+        lines.append(line)
+
+    ax.axhline(y=0.5, color='gray', linestyle='--', linewidth=1)
+
+    ax.set_title(title, fontsize=20)
+    ax.grid(True)
+
+    return lines
+
+def plot_probe_accuracy(results_dir : str, figures_dir : str = "figures", model_names = None):
+    # plotting libraries are only imported here
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    sns.set(font_scale=2)
+    sns.set_palette('colorblind')
+
+    titles = dict(MODELS)
+    model_names = model_names or list(titles)
+    results = load_results(results_dir, model_names, [experiment_name for experiment_name, _, _ in CONDITIONS])
+    fig, axes = plt.subplots(1, len(model_names), figsize=(5 * len(model_names), 6), sharey=True, squeeze=False)
+
+    lines = []
+    for ax, model_name in zip(axes[0], model_names):
+        probe_data = [layer_accuracies(results[f'{experiment_name}_{model_name}']) for experiment_name, _, _ in CONDITIONS]
+        lines = plot_CSLP(ax, probe_data, titles.get(model_name, model_name))
+
+        ax.tick_params(axis='both', which='major', labelsize=20)
+        ax.tick_params(axis='both', which='minor', labelsize=20)
+
+        xticks = list(range(0, max(probe_data[0]['Layer']) + 1, 4))
+        ax.set_xticks(xticks)
+        ax.set_ylim(.45, 1.05)
+        ax.set_xlabel('')
+        ax.set_ylabel('')
+
+    fig.legend(lines, [label for _, label, _ in CONDITIONS], loc='center left', bbox_to_anchor=(.85, 0.5), fontsize=20, title='Condition')
+    fig.text(0.5, 0.01, 'Layer', ha='center', va='center', fontsize=20)
+    fig.text(0.04, 0.5, 'Accuracy', ha='center', va='center', rotation='vertical', fontsize=20)
+    plt.tight_layout(rect=[0.05, 0.02, 0.85, 0.96])
+
+    os.makedirs(figures_dir, exist_ok = True)
+    path = os.path.join(figures_dir, "probe_accuracy.png")
+    fig.savefig(path)
+    plt.close(fig)
+    print(f"Figure saved to {path}")
+    return path
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from transformers import AutoModel, AutoTokenizer
+
+import sys
+sys.path.append("..")
+from functions import attention, probe, surprisal
+from functions.precision import PRECISIONS, apply_precision
+from surprisal_for_model import load_model as load_scorer
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare surprisals, probe accuracies and attention heads at reduced precision against fp32')
+    parser.add_argument('--models', nargs='+', default=['gpt2', 'roberta-base'], help='model names, should be in minicons')
+    parser.add_argument('--precisions', nargs='+', choices=[p for p in PRECISIONS if p != 'fp32'], default=['bf16', 'int8'])
+    parser.add_argument('--analyses', nargs='+', choices=['surprisal', 'probe', 'attention'], default=['surprisal', 'probe', 'attention'])
+    parser.add_argument('--data-dir', default='../data', help='Directory with the stimulus CSVs')
+    parser.add_argument('--n-items', type=int, default=40, help='Items sampled from every stimulus set')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='../data/precision_drift.json', help='Path for the JSON drift report')
+
+    args = parser.parse_args()
+    stimuli = drift_stimuli(args.data_dir, args.n_items, args.seed)
+    analyses = {"surprisal": surprisal_drift, "probe": probe_drift, "attention": attention_drift}
+    report = {}
+    for model_name in args.models:
+        report[model_name] = {}
+        for analysis in args.analyses:
+            print(f"Measuring {analysis} drift for model: {model_name}")
+            for precision, drift in analyses[analysis](model_name, args.precisions, stimuli).items():
+                report[model_name].setdefault(precision, {})[analysis] = drift
+    print_report(report)
+    with open(args.output, 'w') as fp:
+        json.dump(report, fp, indent=2)
+    print(f"Drift report saved to {args.output}")
+
+def sample_items(data : pd.DataFrame, n_items : int, seed : int):
+    items = pd.unique(data['item'])
+    chosen = np.random.default_rng(seed).choice(items, size=min(n_items, len(items)), replace=False)
+    return data[data['item'].isin(chosen)]
+
+def drift_stimuli(data_dir : str, n_items : int, seed : int):
+    # the same item subset is used for every model and precision
+    with open(os.path.join(data_dir, "stimulus_config.json"), "r") as file:
+        stimulus_config = json.load(file)
+    scoring = {filename: sample_items(pd.read_csv(os.path.join(data_dir, filename)), n_items, seed) for filename in stimulus_config}
+    df_comb = pd.read_csv(os.path.join(data_dir, "df_comb.csv"))
+    pairs = probe.probe_experiments(probe.paired_stimuli(df_comb))["WY_rev"]
+    pairs = pairs[[plaus_target in plaus_sent and implaus_target in implaus_sent for plaus_target, plaus_sent, implaus_target, implaus_sent
+                   in zip(pairs['plaus_target'], pairs['plaus_sent'], pairs['implaus_target'], pairs['implaus_sent'])]]
+    attention_data = df_comb[(df_comb.exp == "WY") & df_comb['type'].isin(["substitution", "reversal"])]
+    return {
+        "scoring": scoring,
+        "config": stimulus_config,
+        "pairs": sample_items(pairs, n_items, seed),
+        "attention": sample_items(attention_data, n_items, seed),
+    }
+
+def surprisal_drift(model_name : str, precisions, stimuli):
+    # bits of drift per sentence, and whether the per-item surprisal effects keep their sign and size
+    surprisals = {}
+    for precision in ["fp32"] + precisions:
+        model = load_scorer(model_name, precision)
+        surprisals[precision] = {}
+        for filename, data in stimuli["scoring"].items():
+            sentences = data['sentence'].str.lower() if 'uncased' in model_name else data['sentence']
+            surprisals[precision][filename] = data.assign(model_surprisal=surprisal.surprisal_at_word(model, sentences.tolist(), data['target'].tolist()))
+        del model
+    drift = {}
+    for precision in precisions:
+        reference = np.concatenate([data['model_surprisal'].to_numpy() for data in surprisals["fp32"].values()])
+        scores = np.concatenate([data['model_surprisal'].to_numpy() for data in surprisals[precision].values()])
+        effects = {}
+        for filename, config in stimuli["config"].items():
+            conditions = {"Reversal": config['reversal']} if 'reversal' in config else {}
+            conditions[config['comparison_condition']] = config['comparison']
+            for condition_name, comparison_cols in conditions.items():
+                reference_effect = surprisal.surprisal_effects(surprisals["fp32"][filename], ['model_surprisal'], comparison_cols, condition_name)
+                effect = surprisal.surprisal_effects(surprisals[precision][filename], ['model_surprisal'], comparison_cols, condition_name)
+                reference_effect, effect = reference_effect['model_surprisal_surprisal_effect'], effect['model_surprisal_surprisal_effect']
+                effects[f"{filename}/{condition_name}"] = {
+                    "fp32_mean_effect": float(reference_effect.mean()),
+                    "mean_effect": float(effect.mean()),
+                    "sign_agreement": float((np.sign(reference_effect) == np.sign(effect)).mean()),
+                }
+        drift[precision] = {
+            "max_abs_diff": float(np.abs(scores - reference).max()),
+            "mean_abs_diff": float(np.abs(scores - reference).mean()),
+            "pearson_r": float(np.corrcoef(scores, reference)[0, 1]),
+            "effects": effects,
+        }
+    return drift
+
+def probe_drift(model_name : str, precisions, stimuli):
+    # mean 10-fold accuracy per layer on the same folds at every precision
+    stimuli_list, labels, verbs = probe.process_data(stimuli["pairs"])
+    accuracies = {}
+    for precision in ["fp32"] + precisions:
+        model = probe.load_model(model_name, precision)
+        probe_layers = list(range(1, model.layers + 1))
+        layer_embeddings = probe.extract_verb_embeddings_by_layer(model, stimuli_list, verbs, probe_layers)
+        accuracies[precision] = np.array([np.mean(fold_accuracies) for fold_accuracies in probe.run_layer_probing(layer_embeddings, labels, seed=0, n_jobs=1)])
+        del model
+    return {precision: {
+        "fp32_accuracy": accuracies["fp32"].tolist(),
+        "accuracy": accuracies[precision].tolist(),
+        "max_abs_diff": float(np.abs(accuracies[precision] - accuracies["fp32"]).max()),
+    } for precision in precisions}
+
+def attention_drift(model_name : str, precisions, stimuli):
+    # whether the argmax agent/patient heads per type x plausibility group stay the same
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    heads = {}
+    for precision in ["fp32"] + precisions:
+        model = apply_precision(AutoModel.from_pretrained(model_name), precision).eval()
+        attn_df = attention.process_attention(stimuli["attention"], model, tokenizer)
+        heads[precision] = attn_df.groupby(['type', 'plausibility'])[['agent_layer_head', 'patient_layer_head']].first()
+        del model
+    drift = {}
+    for precision in precisions:
+        same_heads = (heads[precision][['agent_layer_head', 'patient_layer_head']] == heads["fp32"][['agent_layer_head', 'patient_layer_head']]).to_numpy()
+        drift[precision] = {
+            "groups": len(same_heads),
+            "same_agent_head": int(same_heads[:, 0].sum()),
+            "same_patient_head": int(same_heads[:, 1].sum()),
+            "heads": {f"{group_type}/{plausibility}": {"fp32": [list(row['agent_layer_head']), list(row['patient_layer_head'])],
+                                                       precision: [list(changed['agent_layer_head']), list(changed['patient_layer_head'])]}
+                      for ((group_type, plausibility), row), (_, changed) in zip(heads["fp32"].iterrows(), heads[precision].iterrows())},
+        }
+    return drift
+
+def print_report(report):
+    for model_name, precisions in report.items():
+        for precision, drift in precisions.items():
+            print(f"\n{model_name} {precision} vs fp32")
+            if "surprisal" in drift:
+                surprisal_drift = drift["surprisal"]
+                print(f"  surprisal: max |diff| {surprisal_drift['max_abs_diff']:.3f} bits, mean |diff| {surprisal_drift['mean_abs_diff']:.3f} bits, r = {surprisal_drift['pearson_r']:.4f}")
+                for condition, effect in surprisal_drift["effects"].items():
+                    print(f"    {condition}: effect {effect['fp32_mean_effect']:.2f} -> {effect['mean_effect']:.2f}, item signs kept {effect['sign_agreement']:.0%}")
+            if "probe" in drift:
+                print(f"  probe: max |accuracy diff| over layers {drift['probe']['max_abs_diff']:.3f}")
+            if "attention" in drift:
+                attention_drift = drift["attention"]
+                print(f"  attention: same agent head in {attention_drift['same_agent_head']}/{attention_drift['groups']} groups, "
+                      f"same patient head in {attention_drift['same_patient_head']}/{attention_drift['groups']}")
+
+if __name__ == "__main__":
+    main()
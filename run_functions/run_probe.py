@@ -9,195 +9,173 @@ Original file is located at
 # Prepare data
 """
 
+import functools
+import json
+import os
+import sys
+sys.path.append("..")
 import pandas as pd
+from functions import checkpoint, instrument, probe, scheduler
+from functions.options import PROBE_LAYERS, PROBED_EXPERIMENTS
+from functions.store import RepresentationStore, stimuli_hash
 
-df_raw = pd.read_csv(f'/content/drive/MyDrive/LLM_role-reversal/data/df_comb.csv')
-
-# Melt the DataFrame
-melted_sentence = df_raw.melt(id_vars=["exp","item", "type", "plausibility"], value_vars=["sentence"], var_name="variable", value_name="sentences")
-# Pivot the DataFrame to get implaus_sent and plaus_sent columns
-pivoted_sentence = melted_sentence.pivot_table(index=["exp","item","type"], columns="plausibility", values="sentences", aggfunc='first').reset_index()
-pivoted_sentence.columns = ["exp","item", "type","implaus_sent", "plaus_sent"]
-
-# Melt the DataFrame
-melted_target = df_raw.melt(id_vars=["exp","item", "type", "plausibility"], value_vars=["target"], var_name="variable", value_name="targets")
-# Pivot the DataFrame to get implaus_target and plaus_target columns
-pivoted_target = melted_target.pivot_table(index=["exp","item","type"], columns="plausibility", values="targets", aggfunc='first').reset_index()
-pivoted_target.columns = ["exp","item", "type","implaus_target", "plaus_target"]
-
-df_temp = pd.merge(pivoted_sentence,df_raw[["exp","item", "type"]],how='left',on=["exp","item", "type"]).drop_duplicates()
-df = pd.merge(pivoted_target,df_temp[["exp","item", "type",'implaus_sent','plaus_sent']],how='left',on=["exp","item", "type"]).drop_duplicates()
-
-WY_rev = df[(df['exp'] == 'WY') & (df['type'] == 'reversal')]
-LE_rev = df[(df['exp'] == 'LE') & (df['type'] == 'reversal')]
-KO_rev = df[(df['exp'] == 'KO') & (df['type'] == 'reversal')]
-WY_sub = df[(df['exp'] == 'WY') & (df['type'] == 'substitution')]
-WY_con = df[(df['exp'] == 'WY') & (df['type'] == 'control')]
-LE_alt = df[(df['exp'] == 'LE') & (df['type'] == 'alternative')]
-KO_con = df[(df['exp'] == 'KO') & (df['type'] == 'control')]
-WY_LE_rev_comb = pd.concat([WY_rev, LE_rev], ignore_index=True)
-WY_KO_con_comb = pd.concat([WY_con, KO_con], ignore_index=True)
+data_path = '/content/drive/MyDrive/LLM_role-reversal/data/df_comb.csv'
 
 """# Run probe on verb embeddings"""
 
-import json
-import probe
-
-experiments = [
-    (WY_rev, "WY_rev"),
-    (LE_rev, "LE_rev"),
-    (KO_rev, "KO_rev"),
-    (WY_sub, "WY_sub")
-]
-
-model_layers = {
-    'gpt2': 12,
-    'gpt2-medium': 24,
-    'bert-large-uncased' : 24,
-    'roberta-large' : 24
-}
-
-def main():
-    for experiment, experiment_name in experiments:
-      for model_name in model_layers.keys():
-          model = probe.load_model(model_name)
-          print(f"Loaded {model_name}")
-          probe_results = run_probe(model, model_layers[model_name], experiment, prep_fn)
-          write_results(probe_results, f'/content/drive/MyDrive/LLM_role-reversal/results/probe_{experiment_name}_{model_name}.json')
-
-def prep_fn(row):
-    stimuli = [f"{row['plaus_sent']}",
-               f"{row['implaus_sent']}"]
-    labels = [0, 1]  # plausible is 0, implausible is 1
-    verbs = [f"{row['plaus_target']}",
-             f"{row['implaus_target']}"]
-    return stimuli, labels, verbs
-
-def check_stimuli_contains_verb(stimuli, verbs):
-    for stimulus, verb in zip(stimuli, verbs):
-        if verb not in stimulus:
-            print(f"Error: Verb '{verb}' not found in stimulus '{stimulus}'")
-
-def process_data(df, prep_fn):
-    stimuli, labels, verbs = [], [], []
-    for _, row in df.iterrows():
-        row_stimuli, row_labels, row_verbs = prep_fn(row)
-        check_stimuli_contains_verb(row_stimuli, row_verbs)
-        stimuli += row_stimuli
-        labels += row_labels
-        verbs += row_verbs
-    return stimuli, labels, verbs
-
-def run_probe(model, layers, df, prep_fn):
+experiment_names = PROBED_EXPERIMENTS
+
+model_layers = PROBE_LAYERS
+
+# hidden states are cached here, so reruns with new classifier settings skip the models entirely
+store_dir = '/content/drive/MyDrive/LLM_role-reversal/results/representations'
+probe_seed = 0
+n_permutations = 1000
+# 'fp32', 'bf16' or 'int8' (dynamically quantized Linear layers); cached representations are kept per precision
+precision = 'fp32'
+# 'eager' or 'torchscript' (hidden-state graph exported once per model and cached on disk)
+backend = 'eager'
+# one worker process per model (None: as many as there are models and cores); each loads its model once
+n_workers = None
+results_dir = '/content/drive/MyDrive/LLM_role-reversal/results'
+
+def main(data_path = data_path, results_dir = results_dir, store_dir = store_dir, model_layers = model_layers, experiment_names = experiment_names,
+         precision = precision, backend = backend, n_workers = n_workers, probe_seed = probe_seed, n_permutations = n_permutations):
+    df = probe.paired_stimuli(pd.read_csv(data_path))
+    probe_experiments = probe.probe_experiments(df)
+    store = RepresentationStore(store_dir)
+    # each job carries its experiment's stimuli, so workers need nothing from this module's state.
+    # Experiments whose results were written with the same settings are skipped, unfinished ones resume from their per-layer checkpoints
+    jobs = {}
+    for model_name in model_layers:
+        model_jobs = [(experiment_name, probe_experiments[experiment_name]) for experiment_name in experiment_names
+                      if not all(results_match(path, config) for path, config in
+                                 zip(result_paths(results_dir, experiment_name, model_name),
+                                     experiment_configs(model_name, probe_experiments[experiment_name], precision, probe_seed, n_permutations)))]
+        if model_jobs:
+            jobs[model_name] = model_jobs
+    if not jobs:
+        print(f"All results are already in {results_dir}")
+        return
+    scheduler.run_jobs(jobs, functools.partial(load_model, precision = precision, backend = backend),
+                       functools.partial(run_experiment, model_layers = model_layers, store = store, precision = precision,
+                                         probe_seed = probe_seed, n_permutations = n_permutations, checkpoint_dir = os.path.join(results_dir, "checkpoints")),
+                       functools.partial(write_experiment_results, results_dir = results_dir), n_workers)
+    # per-stage timings and peak memory, written when ROLEREVERSAL_TRACE is set
+    instrument.write_trace()
+
+def load_model(model_name, precision = precision, backend = backend):
+    model = probe.load_model(model_name, precision, backend)
+    print(f"Loaded {model_name}")
+    return model
+
+def run_experiment(model, model_name, job, model_layers = model_layers, store = None, precision = precision, probe_seed = probe_seed, n_permutations = n_permutations,
+                   checkpoint_dir = None):
+    # one scheduler job: probe and permutation baseline of one experiment with an already loaded model
+    experiment_name, experiment = job
+    load_fn = lambda name: model
+    probe_checkpoint, permutation_checkpoint = checkpoint_paths(checkpoint_dir, experiment_name, model_name)
+    # the fits use all of this worker's cores, one process each
+    probe_results = run_probe(model_name, model_layers[model_name], experiment, prep_fn, store, load_fn, n_jobs = scheduler.worker_threads(),
+                              precision = precision, probe_seed = probe_seed, checkpoint_path = probe_checkpoint)
+    permutation_results = run_permutation_baseline(model_name, model_layers[model_name], experiment, prep_fn, store, load_fn,
+                                                   precision = precision, probe_seed = probe_seed, n_permutations = n_permutations,
+                                                   checkpoint_path = permutation_checkpoint)
+    # results are written with the settings they were made with, see results_match
+    probe_config, permutation_config = experiment_configs(model_name, experiment, precision, probe_seed, n_permutations)
+    return {"config": probe_config, "layers": probe_results}, {"config": permutation_config, "layers": permutation_results}
+
+def result_paths(results_dir, experiment_name, model_name):
+    name = checkpoint.path_name(model_name)
+    return f'{results_dir}/probe_{experiment_name}_{name}.json', f'{results_dir}/probe_{experiment_name}_{name}_permutation.json'
+
+def checkpoint_paths(checkpoint_dir, experiment_name, model_name):
+    if checkpoint_dir is None:
+        return None, None
+    name = checkpoint.path_name(model_name)
+    return (os.path.join(checkpoint_dir, f'probe_{experiment_name}_{name}.json'),
+            os.path.join(checkpoint_dir, f'probe_{experiment_name}_{name}_permutation.json'))
+
+def results_match(path, config):
+    # an experiment is done if its results exist and were made with this precision, seed, stimuli and number of permutations
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r') as fp:
+        results = json.load(fp)
+    if results.get("config") != config:
+        print(f"Rerunning {path}, it was made with different settings or inputs")
+        return False
+    return True
+
+def write_experiment_results(model_name, job, results, results_dir = results_dir):
+    experiment_name = job[0]
+    probe_results, permutation_results = results
+    probe_path, permutation_path = result_paths(results_dir, experiment_name, model_name)
+    write_results(probe_results, probe_path)
+    write_results(permutation_results, permutation_path)
+    # the results now mark the experiment as done
+    for path in checkpoint_paths(os.path.join(results_dir, "checkpoints"), experiment_name, model_name):
+        checkpoint.discard(path)
+
+prep_fn = probe.prep_fn
+process_data = probe.process_data
+
+def checkpoint_config(model_name, stimuli, verbs, labels, precision, probe_seed, n_permutations = 0):
+    # a checkpoint is only resumed with the same model, stimuli, seed and the folds (and permutations) that seed draws
+    return {"model": model_name, "stimuli": stimuli_hash(stimuli, verbs), "precision": precision, "seed": probe_seed,
+            "n_permutations": n_permutations, "folds": probe.split_hash(labels, seed = probe_seed, n_permutations = n_permutations)}
+
+def experiment_configs(model_name, df, precision = precision, probe_seed = probe_seed, n_permutations = n_permutations):
+    # settings of the probe and permutation results of one experiment, as their checkpoints record them
     stimuli, labels, verbs = process_data(df, prep_fn)
-    probing_results = {}
-    for layer in range(1, layers + 1):
-        embeddings = probe.extract_verb_embeddings(model, stimuli, verbs, layer)
-        print("Finished with embeddings, running classifier")
-        cv_results = probe.run_probing(embeddings, labels)
-        print(f"Accuracy scores for 10-fold CV in layer {layer}: {cv_results}")
-        probing_results[layer] = cv_results
-    return probing_results
+    return (checkpoint_config(model_name, stimuli, verbs, labels, precision, probe_seed),
+            checkpoint_config(model_name, stimuli, verbs, labels, precision, probe_seed, n_permutations))
+
+def run_probe(model_name, layers, df, prep_fn, store, load_fn = load_model, n_jobs = None, precision = precision, probe_seed = probe_seed,
+              checkpoint_path = None):
+    stimuli, labels, verbs = process_data(df, prep_fn)
+    probe_layers = list(range(1, layers + 1))
+    layer_embeddings = dict(zip(probe_layers, probe.cached_verb_embeddings_by_layer(store, model_name, stimuli, verbs, probe_layers, load_fn, precision)))
+    print("Finished with embeddings, running classifier")
+
+    # enough layers per call to give every job a fold to fit, checkpointed after each layer
+    def probe_layers_from(missing):
+        layers_per_call = -(-(n_jobs or os.cpu_count() or 1) // 10)
+        for start in range(0, len(missing), layers_per_call):
+            layers = missing[start:start + layers_per_call]
+            for layer, cv_results in zip(layers, probe.run_layer_probing([layer_embeddings[layer] for layer in layers], labels, seed = probe_seed, n_jobs = n_jobs)):
+                print(f"Accuracy scores for 10-fold CV in layer {layer}: {cv_results}")
+                yield cv_results
+    config = checkpoint_config(model_name, stimuli, verbs, labels, precision, probe_seed)
+    return checkpoint.resume_layers(checkpoint_path, probe_layers, probe_layers_from, config)
+
+def run_permutation_baseline(model_name, layers, df, prep_fn, store, load_fn = load_model, precision = precision, probe_seed = probe_seed,
+                             n_permutations = n_permutations, checkpoint_path = None):
+    # shuffled-label accuracies on the same folds as run_probe; embeddings come from the store.
+    # A resumed run warm-starts the solvers afresh at its first layer
+    stimuli, labels, verbs = process_data(df, prep_fn)
+    probe_layers = list(range(1, layers + 1))
+    layer_embeddings = dict(zip(probe_layers, probe.cached_verb_embeddings_by_layer(store, model_name, stimuli, verbs, probe_layers, load_fn, precision)))
+
+    def baselines_from(missing):
+        baselines = probe.iter_permutation_baseline([layer_embeddings[layer] for layer in missing], labels, n_permutations, seed = probe_seed)
+        for layer, baseline in zip(missing, baselines):
+            print(f"Permutation p-value in layer {layer}: {baseline['p_value']}")
+            yield baseline
+    config = checkpoint_config(model_name, stimuli, verbs, labels, precision, probe_seed, n_permutations)
+    return checkpoint.resume_layers(checkpoint_path, probe_layers, baselines_from, config)
 
 def write_results(probing_results, output_path):
     print(f"Finished probing, writing JSON of results to {output_path}")
-    with open(output_path, 'w') as fp:
+    with open(output_path + '.tmp', 'w') as fp:
         json.dump(probing_results, fp)
+    # results mark an experiment as done, so they must never be half written
+    os.replace(output_path + '.tmp', output_path)
 
-if __name__ == "__main__":
-    main()
+"""# Plot probing accuracy results
 
-"""# Plot probing accuracy results"""
+See plot_probe.py.
+"""
 
-import matplotlib.pyplot as plt
-import pandas as pd
-import json
-import seaborn as sns
-import numpy as np
-sns.set(font_scale=2)
-sns.set_palette('colorblind')
-
-model_names = ['gpt2', 'gpt2-medium', 'bert-large-uncased','roberta-large' ]
-experiment_names = ["WY_rev","LE_rev","KO_rev","WY_sub","WY_con","LE_alt","KO_con","WY_LE_rev_comb","WY_KO_con_comb"]
-
-results = {}
-for model_name in model_names:
-  for experiment_name in experiment_names:
-      file_path = f'/content/drive/MyDrive/LLM_role-reversal/results/probe_{experiment_name}_{model_name}.json'
-      with open(file_path, 'r') as file:
-          key = f"{experiment_name}_{model_name}"
-          results[key] = json.load(file)
-
-# Access the results using the keys, for example:
-# print(results['WY_rev_gpt2'])
-
-def plot_CSLP(ax, probe_data1, probe_data2, probe_data3, title):
-    mean1 = probe_data1.groupby('Layer')['Accuracy'].mean()
-    sem1 = probe_data1.groupby('Layer')['Accuracy'].sem()
-    line1, = ax.plot(mean1.index, mean1, label='swap-arguments', color='blue')
-    ax.fill_between(mean1.index, mean1 - sem1, mean1 + sem1, color='blue', alpha=0.3)
-
-    mean2 = probe_data2.groupby('Layer')['Accuracy'].mean()
-    sem2 = probe_data2.groupby('Layer')['Accuracy'].sem()
-    line2, = ax.plot(mean2.index, mean2, label='change-verb', color='green')
-    ax.fill_between(mean2.index, mean2 - sem2, mean2 + sem2, color='green', alpha=0.3)
-
-    mean3 = probe_data3.groupby('Layer')['Accuracy'].mean()
-    sem3 = probe_data3.groupby('Layer')['Accuracy'].sem()
-    line3, = ax.plot(mean3.index, mean3, label='replace-argument', color='orange')
-    ax.fill_between(mean3.index, mean3 - sem3, mean3 + sem3, color='orange', alpha=0.3)
-
-    ax.axhline(y=0.5, color='gray', linestyle='--', linewidth=1)
-
-    ax.set_title(title, fontsize=20)
-    ax.grid(True)
-
-    return line1, line2, line3
-
-
-fig, axes = plt.subplots(1, 4, figsize=(20, 6), sharey=True)
-
-df1 = "WY_rev"
-df2 = "KO_rev"
-df3 = "WY_sub"
-
-models = [
-    ('gpt2', 'GPT2-small'),
-    ('gpt2-medium', 'GPT2-medium'),
-    ('bert-large-uncased', 'BERT-large'),
-    ('roberta-large', 'RoBERTa-large')
-]
-
-lines = []
-labels = []
-for ax, (model_name, title) in zip(axes, models):
-    probe_data1 = pd.DataFrame(results[f'{df1}_{model_name}']).melt()
-    probe_data1.columns = ['Layer', 'Accuracy']
-    probe_data1['Layer'] = probe_data1['Layer'].astype(int)
-
-    probe_data2 = pd.DataFrame(results[f'{df2}_{model_name}']).melt()
-    probe_data2.columns = ['Layer', 'Accuracy']
-    probe_data2['Layer'] = probe_data2['Layer'].astype(int)
-
-    probe_data3 = pd.DataFrame(results[f'{df3}_{model_name}']).melt()
-    probe_data3.columns = ['Layer', 'Accuracy']
-    probe_data3['Layer'] = probe_data3['Layer'].astype(int)
-
-    line1, line2, line3 = plot_CSLP(ax, probe_data1, probe_data2, probe_data3, title)
-    lines.extend([line1, line2, line3])
-    labels.extend(['swap-arguments','change-verb','replace-argument'])
-
-    ax.tick_params(axis='both', which='major', labelsize=20)
-    ax.tick_params(axis='both', which='minor', labelsize=20)
-
-    xticks = list(range(0, max(probe_data1['Layer']) + 1, 4))
-    ax.set_xticks(xticks)
-    ax.set_ylim(.45, 1.05)
-    ax.set_xlabel('')
-    ax.set_ylabel('')
-
-fig.legend(lines[:3], labels[:3], loc='center left', bbox_to_anchor=(.85, 0.5), fontsize=20, title='Condition')
-fig.text(0.5, 0.01, 'Layer', ha='center', va='center', fontsize=20)
-fig.text(0.04, 0.5, 'Accuracy', ha='center', va='center', rotation='vertical', fontsize=20)
-plt.tight_layout(rect=[0.05, 0.02, 0.85, 0.96])
-plt.show()
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,90 @@
+import argparse
 import os
 import json
 import sys
 
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-sns.set_theme()
-sns.set_palette('colorblind')
 
-from functions import surprisal
+sys.path.append("..")
+from functions import effects, stats
 
-surprisal_path = "../data/surprisal_results"
-results = [file for file in os.listdir(surprisal_path) if "clean.csv" in file and "con" not in file]
-# adding WY control items later
-with open("../data/stimulus_config.json", "r") as file:
-    stimulus_config = json.load(file)
+SCORED_FORMATS = ["csv", "parquet", "feather"]
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute item-level surprisal effects and their statistics, and plot them')
+    parser.add_argument('--surprisal-dir', default='../data/surprisal_results', help='Directory with the scored datasets')
+    parser.add_argument('--config', default='../data/stimulus_config.json', help='Path to the stimulus config')
+    parser.add_argument('--figures-dir', default='figures', help='Directory for the effect plots')
+    parser.add_argument('--resamples', type=int, default=10000, help='Bootstrap and permutation resamples per effect')
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+    effects_path = write_effects(args.surprisal_dir, args.config, args.resamples, args.seed)
+    plot_effects(effects_path, args.figures_dir)
 
 def get_surprisal_cols(df):
     return [column for column in df.columns if "surprisal" in column]
-all_surprisal_effects = []
-for filename in results:
-    df = pd.read_csv(os.path.join(surprisal_path, filename))
-    config = stimulus_config[filename]
-    surprisal_cols = get_surprisal_cols(df)
-    expt = filename.split("_clean.csv")[0]
-    reversal_data = surprisal.surprisal_effects(df, surprisal_cols, config['reversal'], f"Reversal")
-    reversal_data['expt'] = expt
-    comparison_data = surprisal.surprisal_effects(df, surprisal_cols, config['comparison'], f"{config['comparison_condition']}")
-    comparison_data['expt'] = expt
-    all_surprisal_effects.append(reversal_data)
-    all_surprisal_effects.append(comparison_data)
-
-# adding the control items from chow et al separately
-wy_control = pd.read_csv(os.path.join(surprisal_path, "WY_con_clean.csv"))
-surprisal_cols = get_surprisal_cols(wy_control)
-control_data = surprisal.surprisal_effects(df, surprisal_cols, config['comparison'], f"{config['comparison_condition']}")
-control_data['expt'] = 'WY'
-all_surprisal_effects.append(control_data)
-surprisal_effects = pd.concat(all_surprisal_effects)
-
-surprisal_effects.to_csv(os.path.join(surprisal_path, "surprisal_effects.csv"), index = False)
-
-all_effects = pd.read_csv(os.path.join(surprisal_path, "surprisal_effects.csv"))
-all_effects.drop("item", axis = 1, inplace = True)
+
+def read_scored_file(path : str):
+    file_format = os.path.splitext(path)[1][1:]
+    return pd.read_csv(path) if file_format == "csv" else pd.read_parquet(path) if file_format == "parquet" else pd.read_feather(path)
+
+def read_scored(surprisal_path : str, filename : str):
+    # the shell sweep writes CSVs and compute_all_surprisals.py parquet or feather files of the same name, possibly into the same
+    # directory. The newest file is read, and model columns that only an older file has are added from it.
+    stem = os.path.splitext(filename)[0]
+    paths = [os.path.join(surprisal_path, f"{stem}.{file_format}") for file_format in SCORED_FORMATS]
+    paths = sorted([path for path in paths if os.path.exists(path)], key = os.path.getmtime, reverse = True)
+    if not paths:
+        return None
+    df = read_scored_file(paths[0])
+    newest_cols = get_surprisal_cols(df)
+    for path in paths[1:]:
+        other = read_scored_file(path)
+        other_cols = get_surprisal_cols(other)
+        if set(other_cols) != set(newest_cols):
+            print(f"Warning: {paths[0]} and {path} score different models, using the newest file's values for the models both score")
+        missing = [column for column in other_cols if column not in df.columns]
+        if not missing:
+            continue
+        # the shell sweep lowercases the sentences of uncased models in place
+        if len(other) != len(df) or not other['sentence'].str.lower().equals(df['sentence'].str.lower()):
+            print(f"Warning: {path} has different stimuli than {paths[0]}, ignoring its models {missing}")
+            continue
+        df = df.assign(**{column: other[column].to_numpy() for column in missing})
+    return df
+
+def collect_effects(surprisal_path : str, stimulus_config : dict):
+    # reversal and comparison effects of every scored dataset in the config; WY_con_clean.csv adds the Chow et al control items to WY
+    all_surprisal_effects = []
+    for filename, config in stimulus_config.items():
+        df = read_scored(surprisal_path, filename)
+        if df is None:
+            print(f"No scored results for {filename} in {surprisal_path}, skipping")
+            continue
+        surprisal_cols = get_surprisal_cols(df)
+        expt = filename.split("_")[0]
+        if 'reversal' in config:
+            reversal_data = effects.surprisal_effects(df, surprisal_cols, config['reversal'], "Reversal")
+            reversal_data['expt'] = expt
+            all_surprisal_effects.append(reversal_data)
+        comparison_data = effects.surprisal_effects(df, surprisal_cols, config['comparison'], f"{config['comparison_condition']}")
+        comparison_data['expt'] = expt
+        all_surprisal_effects.append(comparison_data)
+    return pd.concat(all_surprisal_effects)
+
+def write_effects(surprisal_path : str, config_path : str, n_resamples : int = 10000, seed : int = 0):
+    with open(config_path, "r") as file:
+        stimulus_config = json.load(file)
+    surprisal_effects = collect_effects(surprisal_path, stimulus_config)
+    effects_path = os.path.join(surprisal_path, "surprisal_effects.csv")
+    surprisal_effects.to_csv(effects_path, index = False)
+
+    # item-level bootstrap CIs and sign-flip permutation p-values per experiment x condition x model
+    effect_stats = stats.effect_statistics(surprisal_effects, ["expt", "condition"], n_resamples = n_resamples, seed = seed)
+    effect_stats.to_csv(os.path.join(surprisal_path, "surprisal_effects_stats.csv"), index = False)
+    print(f"Surprisal effects saved to {effects_path}")
+    return effects_path
 
 # relabeling the experiments based on paper
 def relabel_experiment(row):
@@ -62,43 +104,53 @@ def relabel_experiment(row):
     else:
         return "EXCLUDE"
 
-melted = pd.melt(all_effects, id_vars = ["expt", "condition"])
-melted.columns = ["expt", "condition", "Model", "Surprisal Effect"]
-melted['condition'] = melted.apply(relabel_experiment, axis = 1)
-
-# Plotting for the main experimental effects
-os.mkdir("figures")
-plt.rc('font', size=48)           # controls default text sizes
-plt.rc('axes', titlesize=48)      # fontsize of the axes title
-plt.rc('axes', labelsize=48)      # fontsize of the x and y labels
-plt.rc('xtick', labelsize=48)     # fontsize of the tick labels
-plt.rc('ytick', labelsize=48)     # fontsize of the tick labels
-plt.rc('figure', titlesize=48)    # fontsize of the figure title
-
-expt_conditions = ['swap-arguments', 'change-verb', 'replace-argument']
-final_effect_table = melted[melted['condition'].isin(expt_conditions)]
-g = sns.FacetGrid(final_effect_table, col = "condition", hue = "Model", height = 15, sharex=False, sharey=True, col_wrap=3)
-g.map(sns.barplot, "Model", "Surprisal Effect", order = model_names)
-g.set_titles(template="{col_name}", size = 64)
-g.set_axis_labels("", "Surprisal Effect")
-for ax in g.axes.flatten():
-    ax.set_xticklabels(ax.get_xticklabels(), rotation=45, ha='right')
-g.fig.subplots_adjust(wspace=0.2, hspace=0.35)
-plt.subplots_adjust(left=0.2, right=0.8) 
-plt.figure.savefig("figures/surprisal_effects.png")
-
-# Plotting the control/cloze conditions
-cloze_conditions = ['Kim & Osterhout Control', 'Chow et al Control']
-cloze_effect_table = melted[melted['condition'].isin(cloze_conditions)]
-g = sns.FacetGrid(cloze_effect_table, col = "condition", col_order=expt_conditions, hue = "Model", height = 15, sharex=False, sharey=True, col_wrap=3)
-g.map(sns.barplot, "Model", "Surprisal Effect", order = model_names)
-g.set_titles(template="{col_name}", size = 64)
-g.set_axis_labels("", "Surprisal Effect")
-for ax in g.axes.flatten():
-    ax.set_xticklabels(ax.get_xticklabels(), rotation=45, ha='right')
-g.fig.subplots_adjust(wspace=0.2, hspace=0.35)  # Adjust wspace for horizontal space and hspace for vertical space
-
-# Center the plots by adjusting the left and right margins
-plt.subplots_adjust(left=0.2, right=0.8)  # Adjust these values to center the plots horizontally
-plt.figure.savefig("figures/control_surprisal_effects.png")
+def plot_conditions(melted : pd.DataFrame, conditions, model_names, path : str):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    effect_table = melted[melted['condition'].isin(conditions)]
+    g = sns.FacetGrid(effect_table, col = "condition", col_order = conditions, hue = "Model", height = 15, sharex=False, sharey=True, col_wrap=3)
+    g.map(sns.barplot, "Model", "Surprisal Effect", order = model_names)
+    g.set_titles(template="{col_name}", size = 64)
+    g.set_axis_labels("", "Surprisal Effect")
+    for ax in g.axes.flatten():
+        ax.set_xticklabels(ax.get_xticklabels(), rotation=45, ha='right')
+    g.fig.subplots_adjust(wspace=0.2, hspace=0.35)  # Adjust wspace for horizontal space and hspace for vertical space
+
+    # Center the plots by adjusting the left and right margins
+    plt.subplots_adjust(left=0.2, right=0.8)
+    g.savefig(path)
+    plt.close(g.fig)
+
+def plot_effects(effects_path : str, figures_dir : str = "figures"):
+    # plotting libraries are only imported here, so computing the effects does not pay for them
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    sns.set_theme()
+    sns.set_palette('colorblind')
+
+    all_effects = pd.read_csv(effects_path)
+    all_effects.drop("item", axis = 1, inplace = True)
+    melted = pd.melt(all_effects, id_vars = ["expt", "condition"])
+    melted.columns = ["expt", "condition", "Model", "Surprisal Effect"]
+    melted['condition'] = melted.apply(relabel_experiment, axis = 1)
+    model_names = list(pd.unique(melted['Model']))
+
+    os.makedirs(figures_dir, exist_ok = True)
+    plt.rc('font', size=48)           # controls default text sizes
+    plt.rc('axes', titlesize=48)      # fontsize of the axes title
+    plt.rc('axes', labelsize=48)      # fontsize of the x and y labels
+    plt.rc('xtick', labelsize=48)     # fontsize of the tick labels
+    plt.rc('ytick', labelsize=48)     # fontsize of the tick labels
+    plt.rc('figure', titlesize=48)    # fontsize of the figure title
+
+    # main experimental effects, then the control/cloze conditions
+    paths = [os.path.join(figures_dir, "surprisal_effects.png"), os.path.join(figures_dir, "control_surprisal_effects.png")]
+    plot_conditions(melted, ['swap-arguments', 'change-verb', 'replace-argument'], model_names, paths[0])
+    plot_conditions(melted, ['Kim & Osterhout Control', 'Chow et al Control'], model_names, paths[1])
+    print(f"Figures saved to {figures_dir}")
+    return paths
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import argparse
+import os
+
+import sys
+sys.path.append("..")
+from functions import options
+from functions.options import EXPORT_DIR
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep scorer and embedding models loaded and serve surprisals and sentence embeddings over local HTTP')
+    options.add_serve_options(parser)
+
+    args = parser.parse_args()
+    serve(args.models, args.embed_models, args.host, args.port, args.window_ms / 1000, args.max_batch, args.token_budget, args.prefix_cache,
+          args.target_only, args.precision, args.backend, args.offline, args.export_dir)
+
+def serve(model_names, embed_model_names, host : str = '127.0.0.1', port : int = 8765, window : float = 0.01, max_batch : int = 256,
+          token_budget : int = 8192, prefix_cache : bool = False, target_only : bool = False, precision : str = "fp32", backend : str = "eager",
+          offline : bool = False, export_dir : str = EXPORT_DIR):
+    if offline:
+        # read before the Hugging Face libraries are imported
+        os.environ["HF_HUB_OFFLINE"] = "1"
+        os.environ["TRANSFORMERS_OFFLINE"] = "1"
+    from functions import probe
+    from functions.server import ScoringServer
+    from surprisal_for_model import load_model
+
+    scorers = {model_name: load_model(model_name, precision, backend, export_dir) for model_name in model_names}
+    embedders = {model_name: probe.load_model(model_name, precision, backend, export_dir) for model_name in embed_model_names}
+    server = ScoringServer((host, port), scorers, embedders, window, max_batch, token_budget, prefix_cache, target_only)
+    print(f"Serving {', '.join(scorers) or 'no'} scorer(s) and {', '.join(embedders) or 'no'} embedding model(s) on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Shutting down")
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -6,31 +6,94 @@ from minicons import scorer
 
 import sys
 sys.path.append("..")
+from functions import checkpoint, instrument, options
+from functions.export import EXPORT_DIR, cached_graph, exported_model
+from functions.precision import apply_precision
 from functions.surprisal import surprisal_at_word
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--model', required=True, help='model name, should be in minicons')
     parser.add_argument('--data', required=True, help='Path to file with stimuli')
+    options.add_scoring_options(parser)
+    options.add_model_options(parser)
+    parser.add_argument('--chunk-size', type=int, default=2000, help='Rows read, scored and checkpointed at a time')
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint of an interrupted run and start from the first row')
+    options.add_trace_options(parser)
 
     # Parsing arguments
     args = parser.parse_args()
-    df = pd.read_csv(args.data)
-    model_surprisal(df, args.model)
-    df.to_csv(args.data, index = False) # editing the CSV one model at a time
+    if args.profile:
+        instrument.enable_profiler()
+    stream_model_surprisal(args.data, args.model, args.chunk_size, args.token_budget, args.prefix_cache, args.target_only, args.precision, args.backend,
+                           args.export_dir, args.restart)
+    instrument.write_trace(args.trace)
 
-def load_model(model_name):
-    if 'gpt' in model_name:
-        model = scorer.IncrementalLMScorer(model_name)
+def progress_paths(data_path : str, model_name : str):
+    # scored rows and the checkpoint live next to the data until the run finishes
+    name = checkpoint.path_name(model_name)
+    return f"{data_path}.{name}.partial", f"{data_path}.{name}.checkpoint.json"
+
+def stream_model_surprisal(data_path : str, model_name : str, chunk_size : int = 2000, token_budget : int = 8192, prefix_cache : bool = False,
+                           target_only : bool = False, precision : str = "fp32", backend : str = "eager", export_dir : str = EXPORT_DIR, restart : bool = False):
+    """
+    Adds a {model_name}_surprisal column to the CSV at data_path, editing it in place one model at a time. Rows are read
+    and scored chunk by chunk, and every scored chunk is appended to a partial file next to the data, followed by a
+    checkpoint of the rows done. A rerun after an interruption resumes after the last checkpointed chunk; the data file
+    is replaced only once every row is scored.
+    """
+    partial_path, checkpoint_path = progress_paths(data_path, model_name)
+    config = {"data": checkpoint.file_signature(data_path), "model": model_name, "chunk_size": chunk_size, "token_budget": token_budget,
+              "prefix_cache": prefix_cache, "target_only": target_only, "precision": precision, "backend": backend}
+    state = None if restart else checkpoint.load(checkpoint_path, config)
+    rows_done = state["rows_done"] if state else 0
+    if state:
+        print(f"Resuming {model_name} on {data_path} after {rows_done} scored rows")
+        checkpoint.truncate(partial_path, state["partial_bytes"])
     else:
-        model = scorer.MaskedLMScorer(model_name)
+        checkpoint.discard(partial_path)
+
+    model = None
+    reader = pd.read_csv(data_path, chunksize = chunk_size, skiprows = range(1, rows_done + 1))
+    while True:
+        with instrument.stage("csv_read"):
+            chunk = next(reader, None)
+        if chunk is None:
+            break
+        if model is None:
+            # only loaded when there is something left to score
+            model = load_model(model_name, precision, backend, export_dir)
+        score_chunk(chunk, model, model_name, token_budget, prefix_cache, target_only)
+        with instrument.stage("csv_write", len(chunk)):
+            partial_bytes = checkpoint.append_csv(chunk, partial_path, header = rows_done == 0)
+        rows_done += len(chunk)
+        checkpoint.save(checkpoint_path, {"config": config, "rows_done": rows_done, "partial_bytes": partial_bytes})
+    if rows_done:
+        os.replace(partial_path, data_path) # editing the CSV one model at a time
+    checkpoint.discard(checkpoint_path)
+
+def load_model(model_name, precision : str = "fp32", backend : str = "eager", export_dir : str = EXPORT_DIR):
+    with instrument.stage("load_model"):
+        scorer_class = scorer.IncrementalLMScorer if 'gpt' in model_name else scorer.MaskedLMScorer
+        graph = cached_graph(model_name, "logits", export_dir, precision) if backend == "torchscript" else None
+        if graph is not None:
+            # an exported graph needs only the tokenizer, not the eager model's weights
+            return scorer_class(graph, tokenizer = model_name)
+        model = scorer_class(model_name)
+        model.model = apply_precision(model.model, precision)
+        if backend == "torchscript":
+            model.model = exported_model(model.model, model_name, "logits", export_dir, precision)
     return model
 
-def model_surprisal(data : pd.DataFrame, model_name : str):
-    model = load_model(model_name)
+def model_surprisal(data : pd.DataFrame, model_name : str, token_budget : int = 8192, prefix_cache : bool = False, target_only : bool = False,
+                    precision : str = "fp32", backend : str = "eager", export_dir : str = EXPORT_DIR):
+    model = load_model(model_name, precision, backend, export_dir)
+    score_chunk(data, model, model_name, token_budget, prefix_cache, target_only)
+
+def score_chunk(data : pd.DataFrame, model, model_name : str, token_budget : int = 8192, prefix_cache : bool = False, target_only : bool = False):
     if 'uncased' in model_name:
         data['sentence'] = data['sentence'].str.lower()
-    surprisals = surprisal_at_word(model, data['sentence'].tolist(), data['target'].tolist())
+    surprisals = surprisal_at_word(model, data['sentence'].tolist(), data['target'].tolist(), token_budget, prefix_cache, target_only)
     data[f'{model_name}_surprisal'] = surprisals
 
 if __name__ == "__main__":